@@ -17,11 +17,282 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from django.contrib import admin
-from glass.models   import Tag, Topic, Message
+"""
+Admin classes that stay usable with millions of rows: change lists fetch
+related objects with the rows, relations are edited by ids instead of
+select boxes with every object, unfiltered lists are paginated by
+estimated number of rows (see ‘estimated_count’), deletion is confirmed
+with numbers of objects to delete instead of list of all of them (see
+‘deletion_summary’), and topics are deleted in batches of messages, each
+in its own transaction, so other writes don't wait for the whole topic
+(see ‘delete_topic’).
+"""
+
+import collections
+
+from django.contrib                   import admin, messages
+from django.contrib.admin             import helpers
+from django.contrib.admin.actions     import delete_selected
+from django.contrib.admin.exceptions  import DisallowedModelAdminToField
+from django.contrib.admin.options     import IS_POPUP_VAR, TO_FIELD_VAR
+from django.contrib.admin.utils       import model_ngettext, unquote
+from django.contrib.auth.admin        import UserAdmin
+from django.core.exceptions           import PermissionDenied
+from django.core.paginator            import Paginator
+from django.db                        import DatabaseError, connections
+from django.db                        import models, transaction
+from django.db.models                 import F, Max, Value, Case, When
+from django.http                      import Http404
+from django.template.response         import TemplateResponse
+from glass.likes                      import forget_liked
+from glass.likes                      import get_cache as likes_cache
+from glass.models                     import User, Tag, Topic, Message
+from glass.models                     import UserStats
+from glass.search                     import get_backend as search_backend
+
+DELETE_CHUNK_SIZE = 500 # how many messages are deleted at once
+
+def estimated_count(queryset):
+    """
+    Return number of objects in ‘queryset’. Without filters this is an
+    estimate that doesn't scan the table: statistics of the table on
+    PostgreSQL, the greatest primary key otherwise.
+    """
+    if queryset.query.where:
+        return queryset.count()
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class '
+                               'WHERE relname = %s',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > 0:
+                return int(row[0])
+        except DatabaseError:
+            pass
+    return queryset.aggregate(n=Max('pk'))['n'] or 0
+
+class EstimatedCountPaginator(Paginator):
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+def deletion_summary(modeladmin, request, queryset):
+    """
+    Return tuple: numbers of objects to delete with objects in ‘queryset’
+    as list of (name, number) pairs, and set of names of objects the user
+    may not delete. Only objects that refer to the deleted ones directly
+    are counted, by data base, instead of collecting all of them.
+    """
+    opts = queryset.model._meta
+    model_count = [(opts.verbose_name_plural, queryset.count())]
+    perms_lacking = set()
+    for relation in opts.related_objects:
+        if relation.on_delete is not models.CASCADE:
+            continue
+        related = relation.related_model
+        name = related._meta.verbose_name_plural
+        count = related._base_manager.filter(
+            **{relation.field.name + '__in': queryset}).count()
+        if count:
+            model_count.append((name, count))
+            related_admin = modeladmin.admin_site._registry.get(related)
+            if related_admin is not None and \
+               not related_admin.has_delete_permission(request):
+                perms_lacking.add(name)
+    return model_count, perms_lacking
+
+def delete_objects(modeladmin, request, queryset):
+    """
+    Like standard action that deletes selected objects, but confirmation
+    shows only numbers of objects (see ‘deletion_summary’) and the objects
+    are deleted one by one with ‘delete_model’ of ‘modeladmin’.
+    """
+    opts = modeladmin.model._meta
+    if not modeladmin.has_delete_permission(request):
+        raise PermissionDenied
+    model_count, perms_lacking = deletion_summary(modeladmin, request,
+                                                  queryset)
+    if request.POST.get('post'): # confirmed
+        if perms_lacking:
+            raise PermissionDenied
+        count = 0
+        for obj in queryset:
+            modeladmin.log_deletion(request, obj, str(obj))
+            modeladmin.delete_model(request, obj)
+            count += 1
+        modeladmin.message_user(request, "Successfully deleted {} {}.".format(
+            count, model_ngettext(opts, count)), messages.SUCCESS)
+        return None
+    objects_name = opts.verbose_name if model_count[0][1] == 1 else \
+                   opts.verbose_name_plural
+    context = dict(
+        modeladmin.admin_site.each_context(request),
+        title="Cannot delete {}".format(objects_name) if perms_lacking else
+              "Are you sure?",
+        objects_name=objects_name,
+        deletable_objects=[[str(obj) for obj in queryset[:100]]],
+        model_count=model_count,
+        queryset=queryset,
+        perms_lacking=perms_lacking,
+        protected=[],
+        opts=opts,
+        action_checkbox_name=helpers.ACTION_CHECKBOX_NAME)
+    request.current_app = modeladmin.admin_site.name
+    return TemplateResponse(request,
+                            modeladmin.delete_selected_confirmation_template or
+                            'admin/delete_selected_confirmation.html',
+                            context)
+delete_objects.short_description = delete_selected.short_description
+
+class ScalableAdmin(admin.ModelAdmin):
+    """
+    Base of admin classes of big tables.
+    """
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = [delete_objects]
+
+    def get_actions(self, request):
+        actions = super(ScalableAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None) # replaced by ‘delete_objects’
+        return actions
+
+    def delete_view(self, request, object_id, extra_context=None):
+        """
+        Standard deletion view, but confirmation shows only numbers of
+        objects, see ‘deletion_summary’.
+        """
+        opts = self.model._meta
+        to_field = request.POST.get(TO_FIELD_VAR,
+                                    request.GET.get(TO_FIELD_VAR))
+        if to_field and not self.to_field_allowed(request, to_field):
+            raise DisallowedModelAdminToField(
+                "The field {} cannot be referenced.".format(to_field))
+        obj = self.get_object(request, unquote(object_id), to_field)
+        if not self.has_delete_permission(request, obj):
+            raise PermissionDenied
+        if obj is None:
+            raise Http404("{} object with primary key {!r} does not exist."
+                          .format(opts.verbose_name, object_id))
+        model_count, perms_lacking = deletion_summary(
+            self, request, self.model._base_manager.filter(pk=obj.pk))
+        if request.POST: # confirmed
+            if perms_lacking:
+                raise PermissionDenied
+            obj_display = str(obj)
+            obj_id = obj.serializable_value(str(to_field) if to_field else
+                                            opts.pk.attname)
+            self.log_deletion(request, obj, obj_display)
+            self.delete_model(request, obj)
+            return self.response_delete(request, obj_display, obj_id)
+        context = dict(
+            self.admin_site.each_context(request),
+            title="Cannot delete {}".format(opts.verbose_name)
+                  if perms_lacking else "Are you sure?",
+            object_name=opts.verbose_name,
+            object=obj,
+            deleted_objects=[str(obj)],
+            model_count=model_count,
+            perms_lacking=perms_lacking,
+            protected=[],
+            opts=opts,
+            app_label=opts.app_label,
+            preserved_filters=self.get_preserved_filters(request),
+            is_popup=(IS_POPUP_VAR in request.POST or
+                      IS_POPUP_VAR in request.GET),
+            to_field=to_field)
+        context.update(extra_context or {})
+        return self.render_delete_form(request, context)
+
+def decreased(field, amounts):
+    """
+    Return expression of ‘field’ of ‘UserStats’ decreased by amounts given
+    per user id, for update of statistics of many users with one query.
+    """
+    cases = [When(user=user_id, then=Value(amount))
+             for user_id, amount in amounts.items() if amount]
+    if not cases:
+        return F(field)
+    return F(field) - Case(*cases, default=Value(0))
+
+def delete_topic(topic, chunk_size=DELETE_CHUNK_SIZE):
+    """
+    Delete ‘topic’ with its messages, newest messages first, ‘chunk_size’
+    messages per transaction. Messages are deleted in bulk, without signals
+    sent per message (see ‘glass.signals’): every chunk takes fixed number
+    of queries, and the topic and index page are touched once, when the
+    topic itself is deleted.
+    """
+    messages = Message.objects.filter(topic=topic).order_by('-id')\
+                              .values_list('id', 'author', 'like_count')
+    while True:
+        with transaction.atomic():
+            chunk = list(messages[:chunk_size])
+            if not chunk:
+                break
+            delete_messages(topic, chunk)
+    topic.delete()
+
+def delete_messages(topic, chunk):
+    """
+    Delete messages of ‘topic’ given as (id, author id, number of likes)
+    tuples, ordered by id descending, with what refers to them.
+    """
+    ids = [message_id for message_id, _, _ in chunk]
+    posted, liked = collections.Counter(), collections.Counter()
+    for _, author_id, like_count in chunk:
+        posted[author_id] += 1
+        liked[author_id] += like_count
+    # initial message is the oldest one, so it goes in the last chunk
+    started = Topic.objects.filter(id=topic.id, first_message__in=ids)\
+                           .update(first_message=None)
+    UserStats.objects.filter(user__in=list(posted)).update(
+        messages=decreased('messages', posted),
+        likes=decreased('likes', liked),
+        topics=decreased('topics', {chunk[-1][1]: started}))
+    likes = Message.likers.through.objects.filter(message__in=ids)
+    if likes_cache() is not None:
+        forget_liked(likes.values_list('user', flat=True).distinct())
+    search_backend().remove_messages(ids)
+    # nothing else refers to the messages, delete rows right away:
+    likes._raw_delete(likes.db)
+    deleted = Message.objects.filter(id__in=ids)
+    deleted._raw_delete(deleted.db)
+
+class TopicAdmin(ScalableAdmin):
+
+    list_display  = ('title', 'slug', 'rating', 'created', 'last_posted',
+                     'archived')
+    search_fields = ('title',)
+    ordering      = ('-id',)
+
+    def delete_model(self, request, obj):
+        delete_topic(obj)
+
+class MessageAdmin(ScalableAdmin):
+
+    list_display        = ('id', 'author', 'topic', 'created', 'like_count')
+    list_select_related = ('author', 'topic')
+    raw_id_fields       = ('author', 'topic')
+    # likes are changed only by ‘toggle_like’, which keeps counters right
+    exclude             = ('likers',)
+    readonly_fields     = ('like_count',)
+    ordering            = ('-id',)
+
+class GlassUserAdmin(UserAdmin, ScalableAdmin):
+    pass
 
 admin.site.register(Tag)
-admin.site.register(Topic)
-admin.site.register(Message)
+admin.site.register(Topic, TopicAdmin)
+admin.site.register(Message, MessageAdmin)
+admin.site.unregister(User)
+admin.site.register(User, GlassUserAdmin)
 
 admin.site.site_header = 'Глас Admin'
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Admission control of requests that write to data base
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Data base has single writer, so under bursts of writes requests queue up
+behind its lock until they time out. ‘AdmissionMiddleware’ rejects excess
+writes (requests of signed in users to views decorated with ‘writes’)
+right away instead, with ‘Retry-After’ header:
+
+* every user has a bucket of ‘GLASS_WRITE_BURST’ tokens that refills with ‘GLASS_WRITE_RATE’ tokens
+  per second, every write takes a token, writes without tokens get 429;
+
+* at most ‘GLASS_MAX_WRITES_IN_FLIGHT’ writes run at once, others get 503;
+
+* when recent writes of a view took longer than
+  ‘GLASS_WRITE_LATENCY_TARGET’ seconds on average, new writes of the view
+  get 503 until the writes in flight finish.
+
+Reads, sign in, registration and the like are never rejected. The state
+is kept in cache ‘GLASS_ADMISSION_CACHE’. With local memory cache (the
+default) every process has its own limits; they are global only with
+a cache shared by all processes whose ‘incr’ is atomic, like Memcached.
+Buckets and averages are updated without locking, so they are approximate
+under contention.
+"""
+
+import math
+import time
+
+from django.conf       import settings
+from django.core.cache import caches
+from django.http       import HttpResponse, JsonResponse
+from glass.metrics     import registry
+
+IN_FLIGHT_KEY     = 'glass:writes-in-flight'
+IN_FLIGHT_TIMEOUT = 60  # forget writes of processes that died meanwhile
+LATENCY_WEIGHT    = 0.2 # weight of the latest write in average latency
+
+def writes(view):
+    """
+    Decorator for views that write to data base on every request, so they
+    are subject to admission control.
+    """
+    view.glass_writes = True
+    return view
+
+def writes_on(*methods):
+    """
+    Like ‘writes’, but only requests with given ‘methods’ write, like POST
+    of a form.
+    """
+    def decorator(view):
+        view.glass_writes = frozenset(methods)
+        return view
+    return decorator
+
+def is_write(request, view):
+    """
+    Whether ‘request’ to ‘view’ is subject to admission control.
+    """
+    methods = getattr(view, 'glass_writes', False)
+    if methods is True:
+        return True
+    return bool(methods) and request.method in methods
+
+def get_cache():
+    alias = getattr(settings, 'GLASS_ADMISSION_CACHE', None)
+    return caches[alias] if alias else None
+
+def rejected(request, status, retry_after, message):
+    """
+    Return response rejecting ‘request’: JSON object with ‘error’ for AJAX
+    requests (like the views they call), plain text otherwise.
+    """
+    retry_after = max(1, math.ceil(retry_after))
+    if request.is_ajax():
+        response = JsonResponse({'error': message, 'retry_after': retry_after},
+                                status=status)
+    else:
+        response = HttpResponse(message, status=status,
+                                content_type='text/plain')
+    response['Retry-After'] = retry_after
+    return response
+
+def take_token(cache, request):
+    """
+    Take token from bucket of author of ‘request’. Return ‘None’ on success
+    or number of seconds until there is a token.
+    """
+    rate = getattr(settings, 'GLASS_WRITE_RATE', 1)
+    burst = getattr(settings, 'GLASS_WRITE_BURST', 30)
+    key = 'glass:bucket:{}'.format(request.user.id)
+    now = time.time()
+    tokens, updated = cache.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    # the bucket is full again when nobody touches it for this long:
+    cache.set(key, (tokens - 1, now), math.ceil(burst / rate))
+    return None
+
+def in_flight(cache):
+    return max(0, cache.get(IN_FLIGHT_KEY, 0))
+
+def change_in_flight(cache, delta):
+    """
+    Add ‘delta’ to number of writes in flight. Only atomic ‘add’ and
+    ‘incr’ touch the counter, so concurrent changes are not lost. It
+    expires ‘IN_FLIGHT_TIMEOUT’ seconds after creation, which forgets
+    writes of processes that died meanwhile; writes that finish after that
+    may leave it below zero until it expires again, which counts as zero.
+    """
+    cache.add(IN_FLIGHT_KEY, 0, IN_FLIGHT_TIMEOUT)
+    try:
+        cache.incr(IN_FLIGHT_KEY, delta)
+    except ValueError: # expired right now
+        pass
+
+def latency_key(view_name):
+    return 'glass:write-latency:{}'.format(view_name)
+
+class AdmissionMiddleware():
+    """
+    Reject writes that would overload data base, see module's description.
+    This should go after authentication middleware.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        cache = get_cache()
+        if cache is None or not request.user.is_authenticated() or \
+           not is_write(request, view_func):
+            return None
+        match = request.resolver_match
+        view_name = match.url_name or 'unresolved'
+        current = in_flight(cache)
+        latency = cache.get(latency_key(view_name), 0)
+        target = getattr(settings, 'GLASS_WRITE_LATENCY_TARGET', 1)
+        if current >= getattr(settings, 'GLASS_MAX_WRITES_IN_FLIGHT', 8) or \
+           (current and latency > target):
+            registry.inc('glass_writes_shed_total', view_name)
+            return rejected(request, 503, latency,
+                            "Server is busy, try again.")
+        wait = take_token(cache, request)
+        if wait is not None:
+            registry.inc('glass_writes_throttled_total', view_name)
+            return rejected(request, 429, wait,
+                            "Too many requests, slow down.")
+        change_in_flight(cache, 1)
+        request._admission = (view_name, time.perf_counter())
+        return None
+
+    def process_response(self, request, response):
+        admission = getattr(request, '_admission', None)
+        if admission is None:
+            return response
+        del request._admission
+        view_name, start = admission
+        cache = get_cache()
+        change_in_flight(cache, -1)
+        key = latency_key(view_name)
+        latency = time.perf_counter() - start
+        average = cache.get(key)
+        if average is not None:
+            latency = LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * average
+        cache.set(key, latency, IN_FLIGHT_TIMEOUT)
+        return response
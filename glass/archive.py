@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Static snapshots of pages of archived topics
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Topics nobody has posted to for a long time are archived by
+‘archive_topics’ command: their pages with all messages are rendered as
+seen by anonymous users and saved gzipped into ‘GLASS_ARCHIVE_ROOT’.
+Anonymous requests of such pages are answered with these files by
+‘serve_archived’ without data base queries or rendering.
+
+Any change of archived topic (see ‘touch_topics’) deletes its snapshot,
+so the topic is served as usual until it's archived again. Without
+‘GLASS_ARCHIVE_ROOT’ nothing is archived.
+"""
+
+import functools
+import gzip
+import os
+import re
+
+from django.conf         import settings
+from django.http         import FileResponse, HttpResponseNotModified
+from django.utils.http   import http_date
+from django.views.static import was_modified_since
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+def archive_root():
+    return getattr(settings, 'GLASS_ARCHIVE_ROOT', None)
+
+def snapshot_path(slug):
+    return os.path.join(archive_root(), os.path.basename(slug) + '.html.gz')
+
+def save_snapshot(slug, chunks):
+    """
+    Write page of topic ‘slug’ given as iterable of strings into its
+    snapshot. Requests never see partially written file.
+    """
+    path = snapshot_path(slug)
+    temp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with gzip.open(temp, 'wt', encoding='utf-8') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp): # writing failed
+            os.remove(temp)
+
+def forget_snapshots(slugs):
+    """
+    Delete snapshots of topics with given ‘slugs’ if they exist.
+    """
+    for slug in slugs:
+        try:
+            os.remove(snapshot_path(slug))
+        except FileNotFoundError:
+            pass
+
+def serve_archived(view):
+    """
+    Decorator for topic view that answers safe requests of anonymous users
+    with snapshot of the topic if it's archived. Clients that don't accept
+    gzip get the snapshot decompressed on the fly.
+    """
+    @functools.wraps(view)
+    def wrapper(request, slug, *args, **kwargs):
+        if not archive_root() or request.method not in ('GET', 'HEAD') or \
+           request.user.is_authenticated():
+            return view(request, slug, *args, **kwargs)
+        try:
+            f = open(snapshot_path(slug), 'rb')
+        except FileNotFoundError:
+            return view(request, slug, *args, **kwargs)
+        stat = os.fstat(f.fileno())
+        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                  stat.st_mtime, stat.st_size):
+            f.close()
+            return HttpResponseNotModified()
+        if ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            response = FileResponse(f, content_type='text/html; charset=utf-8')
+            response['Content-Encoding'] = 'gzip'
+            response['Content-Length'] = stat.st_size
+        else:
+            response = FileResponse(gzip.GzipFile(fileobj=f, mode='rb'),
+                                    content_type='text/html; charset=utf-8')
+            response._closable_objects.append(f) # not closed by ‘GzipFile’
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        response['Vary'] = 'Accept-Encoding, Cookie'
+        response['Cache-Control'] = 'public, max-age={}'.format(
+            getattr(settings, 'GLASS_PAGE_MAX_AGE', 0))
+        return response
+    return wrapper
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Fingerprinted and precompressed static files
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Static files are built by ‘collectstatic’ command into ‘STATIC_ROOT’ with
+‘AssetStorage’: every file gets a copy with hash of its content in its name
+(references between CSS files and fonts are rewritten accordingly), a
+manifest maps original names to hashed ones for ‘{% static %}’ tag, and
+compressible files get gzipped variants and, if ‘brotli’ package is
+installed, brotli variants.
+
+‘AssetMiddleware’ serves built files choosing the best variant the client
+accepts. Files with hashed names never change, so they can be cached by
+everyone for ‘GLASS_ASSET_MAX_AGE’ seconds; other files are revalidated.
+In debug mode files are served by ‘staticfiles’ application as usual.
+"""
+
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf                        import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http                        import FileResponse
+from django.http                        import HttpResponseNotModified
+from django.utils._os                   import safe_join
+from django.utils.http                  import http_date
+from django.views.static                import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.eot', '.ttf', '.ico', '.json')
+
+# Content encodings in order of preference and suffixes of their variants.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+HASHED = re.compile(r'\.[0-9a-f]{12}\.[^./]+$') # see ‘hashed_name’
+
+def compressors():
+    """
+    Return list of (suffix, function) pairs for available compressions.
+    """
+    result = [('.gz', lambda data: gzip.compress(data, 9))]
+    if brotli is not None:
+        result.append(('.br', brotli.compress))
+    return result
+
+class AssetStorage(ManifestStaticFilesStorage):
+    """
+    Storage of built static files, see module's description.
+    """
+
+    def stored_name(self, name):
+        try:
+            return super(AssetStorage, self).stored_name(name)
+        except ValueError: # files are not built, use original name
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super(AssetStorage, self).post_process(paths, dry_run,
+                                                          **options)
+        if dry_run:
+            return
+        names = set(self.hashed_files.keys()) | \
+                set(self.hashed_files.values())
+        for name in names:
+            if name.endswith(COMPRESSIBLE):
+                self.compress(name)
+
+    def compress(self, name):
+        """
+        Save compressed variants of file ‘name’ next to it, but only those
+        that are smaller.
+        """
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        for suffix, compress in compressors():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                with open(path + suffix, 'wb') as f:
+                    f.write(compressed)
+            elif os.path.exists(path + suffix): # left from previous build
+                os.remove(path + suffix)
+
+def accepted_encodings(request):
+    """
+    Return set of content encodings accepted by client.
+    """
+    result = set()
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        encoding, _, params = item.partition(';')
+        if not re.match(r'\s*q=0(\.0*)?\s*$', params):
+            result.add(encoding.strip().lower())
+    return result
+
+class AssetMiddleware():
+    """
+    Serve files from ‘STATIC_ROOT’. This should go first, so requests of
+    static files skip everything else.
+    """
+
+    def process_request(self, request):
+        if settings.DEBUG or not settings.STATIC_ROOT or \
+           request.method not in ('GET', 'HEAD') or \
+           not request.path.startswith(settings.STATIC_URL):
+            return None
+        name = request.path[len(settings.STATIC_URL):]
+        path = safe_join(settings.STATIC_ROOT, name)
+        if not os.path.isfile(path):
+            return None # not found by URL resolver
+        accepted = accepted_encodings(request)
+        encoding = None
+        for candidate, suffix in ENCODINGS:
+            if candidate in accepted and os.path.isfile(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+        stat = os.stat(path)
+        if was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                              stat.st_mtime, stat.st_size):
+            content_type, _ = mimetypes.guess_type(name)
+            response = FileResponse(
+                open(path, 'rb'),
+                content_type=content_type or 'application/octet-stream')
+            response['Content-Length'] = stat.st_size
+            response['Last-Modified'] = http_date(stat.st_mtime)
+            if encoding:
+                response['Content-Encoding'] = encoding
+        else:
+            response = HttpResponseNotModified()
+        response['Vary'] = 'Accept-Encoding'
+        if HASHED.search(name):
+            response['Cache-Control'] = 'public, max-age={}, immutable'\
+                .format(getattr(settings, 'GLASS_ASSET_MAX_AGE', 31536000))
+        else:
+            response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+        return response
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Conditional requests of pages
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Validators (ETag and Last-Modified) of pages are computed without
+rendering anything, so unchanged pages are answered with 304 right away.
+
+Every change that shows on pages of a topic increments its ‘version’ and
+updates its ‘modified’ time (see ‘touch_topics’). Index page is validated
+the same way by single ‘IndexState’ row, which changes with every topic
+that is created or deleted and every change that shows on index page (see
+‘touch_index’). Validators also
+depend on user, because pages differ per user, and on current date,
+because dates are shown relative to it.
+"""
+
+import datetime
+import functools
+import hashlib
+
+from django.conf                  import settings
+from django.shortcuts             import get_object_or_404
+from django.utils                 import timezone
+from django.utils.cache           import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+from glass.models                 import IndexState, Topic
+
+def midnight():
+    """
+    Return beginning of current day, pages change then.
+    """
+    now = timezone.localtime(timezone.now())
+    return now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def make_etag(request, *parts):
+    user = request.user
+    parts += (user.id if user.is_authenticated() else 'anonymous',
+              datetime.date.today().isoformat())
+    return hashlib.md5(':'.join(map(str, parts)).encode()).hexdigest()
+
+def get_topic(request, slug):
+    """
+    Return topic identified by ‘slug’, fetching it only once per request.
+    """
+    topic = getattr(request, '_glass_topic', None)
+    if topic is None:
+        topic = request._glass_topic = get_object_or_404(Topic, slug=slug)
+    return topic
+
+def topic_etag(request, slug):
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    topic = get_topic(request, slug)
+    return make_etag(request, topic.id, topic.version)
+
+def topic_last_modified(request, slug):
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    return max(get_topic(request, slug).modified, midnight())
+
+def index_state(request):
+    """
+    Return ‘IndexState’, fetching it only once per request.
+    """
+    state = getattr(request, '_glass_index_state', None)
+    if state is None:
+        state = IndexState.objects.filter(id=IndexState.ID).first()
+        if state is None: # nothing has been touched yet
+            state = IndexState(modified=midnight())
+        request._glass_index_state = state
+    return state
+
+def index_etag(request):
+    return make_etag(request, index_state(request).version)
+
+def index_last_modified(request):
+    return max(index_state(request).modified, midnight())
+
+def conditional_page(etag_func, last_modified_func):
+    """
+    Decorator that answers conditional requests of the page with 304 when
+    it has not changed and adds headers that control caching: responses for
+    anonymous users can be stored by shared caches for
+    ‘GLASS_PAGE_MAX_AGE’ seconds, others are private.
+    """
+    def decorator(view):
+        conditional_view = condition(etag_func, last_modified_func)(view)
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if request.method not in ('GET', 'HEAD'):
+                return response
+            patch_vary_headers(response, ['Cookie'])
+            if request.user.is_authenticated():
+                patch_cache_control(response, private=True, max_age=0)
+            else:
+                patch_cache_control(
+                    response, public=True,
+                    max_age=getattr(settings, 'GLASS_PAGE_MAX_AGE', 0))
+            return response
+        return wrapper
+    return decorator
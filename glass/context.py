@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Batch loading of data necessary to render pages of Glass application
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf      import settings
+from glass.fragments import get_fragments, stitch
+from glass.likes     import liked_ids
+from glass.models    import Message
+
+def topic_page(topic, after=None, before=None, anchor=None):
+    """
+    Return page of messages in ‘topic’ using keyset pagination: messages
+    that go right ‘after’ given message id, messages that go right ‘before’
+    given message id, or messages starting with ‘anchor’ message. Without
+    arguments this is the first page. Every variant is a single range query
+    on index.
+    """
+    size = getattr(settings, 'GLASS_TOPIC_PAGE_SIZE', 50)
+    messages = Message.objects.filter(topic=topic).select_related('author')
+    if before is not None:
+        page = messages.filter(id__lt=before).order_by('-id')[:size]
+        return list(reversed(page))
+    if anchor is not None:
+        return list(messages.filter(id__gte=anchor)[:size])
+    return list(messages.filter(id__gt=after or 0)[:size])
+
+def last_message_id(topic):
+    return Message.objects.filter(topic=topic)\
+                          .order_by('-id')\
+                          .values_list('id', flat=True)\
+                          .first()
+
+class TopicRenderContext():
+    """
+    Everything that is needed to render messages of a topic for given user:
+    messages with their authors, id of the last message in the topic (only
+    it can be edited by its author), and ids of messages the user likes.
+
+    This takes fixed number of queries no matter how many messages there
+    are, so templates should ask this object instead of the messages.
+
+    ‘messages’ may be a page of messages of the topic (ordered by id), then
+    ‘has_previous’ and ‘has_next’ tell if there are more messages before and
+    after the page. Id of the last message in topic can be passed as
+    ‘last_id’ if it's already known.
+    """
+
+    def __init__(self, topic, user, messages=None, last_id=None):
+        if messages is None:
+            messages = Message.objects.filter(topic=topic)\
+                                      .select_related('author')
+        self.topic    = topic
+        self.user     = user
+        self.messages = list(messages)
+        for message in self.messages:
+            message.topic = topic # avoid fetching the topic again
+        self.fragments = None
+        self.last_id  = last_id if last_id is not None else \
+                        last_message_id(topic)
+        self.has_previous = bool(self.messages) and \
+                            self.messages[0].id != topic.first_message_id
+        self.has_next = bool(self.messages) and \
+                        self.messages[-1].id != self.last_id
+        self.liked_ids = liked_ids(user, (m.id for m in self.messages))
+
+    def liked(self, message):
+        """
+        Does the user like ‘message’?
+        """
+        return message.id in self.liked_ids
+
+    def editable(self, message):
+        """
+        Can the user delete/edit ‘message’?
+        """
+        return message.editable_by(self.user, last_id=self.last_id)
+
+    def render(self, message):
+        """
+        Render ‘message’ for the user. Fragments of all messages are fetched
+        from cache at once.
+        """
+        if self.fragments is None:
+            self.fragments = get_fragments(self.messages)
+        return stitch(self.fragments[message.id],
+                      message,
+                      self.user,
+                      self.liked(message),
+                      self.editable(message))
+
+# Rendered page of topic is split here to stream messages into it.
+MESSAGES_PLACEHOLDER = '<!--glass:messages-->'
+
+def stream_messages(topic, user, last_id):
+    """
+    Generate rendered messages of ‘topic’ up to message with id ‘last_id’,
+    in batches of ‘GLASS_STREAM_BATCH_SIZE’ messages, so the whole topic is
+    never kept in memory. Every batch takes fixed number of queries.
+    """
+    size = getattr(settings, 'GLASS_STREAM_BATCH_SIZE', 200)
+    messages = Message.objects.filter(topic=topic, id__lte=last_id or 0)\
+                              .select_related('author')
+    after = 0
+    while True:
+        batch = list(messages.filter(id__gt=after)[:size])
+        if not batch:
+            return
+        topic_context = TopicRenderContext(topic, user, batch, last_id)
+        yield ''.join(map(topic_context.render, batch))
+        after = batch[-1].id
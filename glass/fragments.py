@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Cache of rendered messages
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Rendered message (see ‘message.html’) is the same for every user except for
+like badge and footer with edit/delete links. So the message is rendered
+once with placeholders in place of these parts and cached (see
+‘get_fragments’). The placeholders are then replaced with parts specific to
+the user (see ‘stitch’). Links to author and to the message itself are put
+in the same way, so renamed topics and users don't need the fragments
+rendered again.
+
+Cache key includes ‘Message.version’, so editing message makes old
+fragment obsolete. It also includes current date, because dates are
+rendered relatively to it (“today”, “yesterday”).
+"""
+
+import datetime
+
+from django.conf              import settings
+from django.core.cache        import caches
+from django.core.urlresolvers import reverse
+from django.template.loader   import render_to_string
+from django.utils.html        import escape, format_html
+from django.utils.safestring  import mark_safe
+
+BADGE_PLACEHOLDER     = '<!--glass:like-badge-->'
+FOOTER_PLACEHOLDER    = '<!--glass:footer-->'
+AUTHOR_PLACEHOLDER    = '<!--glass:author-->'
+PERMALINK_PLACEHOLDER = '<!--glass:permalink-->'
+
+def get_cache():
+    return caches[getattr(settings, 'GLASS_FRAGMENT_CACHE', 'default')]
+
+def fragment_key(message):
+    return 'glass:message:{}:{}:{}'.format(message.id,
+                                           message.version,
+                                           datetime.date.today().isoformat())
+
+def get_fragments(messages):
+    """
+    Return dictionary from ids of ‘messages’ to their rendered fragments.
+    Cache is consulted with single lookup, missing fragments are rendered
+    and put into the cache.
+    """
+    cache = get_cache()
+    keys = {fragment_key(m): m for m in messages}
+    found = cache.get_many(keys.keys())
+    rendered = {}
+    for key, message in keys.items():
+        if key not in found:
+            rendered[key] = render_to_string('message.html',
+                                             {'message': message})
+    if rendered:
+        cache.set_many(rendered)
+    found.update(rendered)
+    return {message.id: found[key] for key, message in keys.items()}
+
+def forget_fragment(message):
+    """
+    Remove fragment of ‘message’ from cache.
+    """
+    get_cache().delete(fragment_key(message))
+
+def stitch(fragment, message, user, liked, editable):
+    """
+    Put parts specific to ‘user’ into ‘fragment’ of ‘message’.
+    """
+    badge = ''
+    if user.is_authenticated():
+        badge = render_to_string('like-badge.html', {'message': message,
+                                                     'user':    user,
+                                                     'liked':   liked})
+    footer = ''
+    if editable:
+        footer = render_to_string('message-footer.html', {'message': message})
+    username = message.author.username
+    author = format_html('<a href="{}">{}</a>',
+                         reverse('user', args=[username]), username)
+    return mark_safe(fragment.replace(AUTHOR_PLACEHOLDER, author, 1)
+                             .replace(PERMALINK_PLACEHOLDER,
+                                      escape(message.get_absolute_url()), 1)
+                             .replace(BADGE_PLACEHOLDER, badge, 1)
+                             .replace(FOOTER_PLACEHOLDER, footer, 1))
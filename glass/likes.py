@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#
+# Toggling of likes with optional coalescing of writes
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Which messages does user like? ‘liked_ids’ answers this for all messages
+on a page with single query. Sets of liked messages of “power users” (at
+least ‘GLASS_LIKED_CACHE_MIN’ likes) are kept in cache ‘GLASS_LIKES_CACHE’
+as compact arrays, so they are answered without queries at all. The cache
+must be shared by all processes (without it nothing is cached). Every
+change of likes of a user, by toggle or other means, drops the array (see
+‘forget_liked’) and it's rebuilt when needed; arrays are never patched,
+since concurrent patches would lose each other's changes.
+
+When ‘GLASS_LIKE_COALESCE_WINDOW’ is positive, toggles of the same like
+(same user and message) that arrive within that many seconds are collected
+in memory of the process and only the state the user ends up with is
+written to data base when the window is over: even number of toggles
+writes nothing at all. The answer is predicted from the state before the
+window plus pending toggles.
+"""
+
+import array
+import bisect
+import logging
+import threading
+import time
+
+from django.conf       import settings
+from django.core.cache import caches
+from django.db         import connection
+from glass.models      import Message
+
+FEW = 'few' # cached instead of array for users with few likes
+
+logger = logging.getLogger(__name__)
+
+def get_cache():
+    alias = getattr(settings, 'GLASS_LIKES_CACHE', None)
+    return caches[alias] if alias else None
+
+def liked_key(user_id):
+    return 'glass:liked:{}'.format(user_id)
+
+def liked_ids(user, message_ids):
+    """
+    Return set of ids among ‘message_ids’ of messages that ‘user’ likes.
+    This takes at most one query (two once in a while for power users).
+    """
+    message_ids = set(message_ids)
+    if not message_ids or not user.is_authenticated():
+        return set()
+    liked = Message.likers.through.objects.filter(user=user)\
+                                          .values_list('message_id', flat=True)
+    cache = get_cache()
+    if cache is None:
+        return set(liked.filter(message__in=message_ids))
+    key = liked_key(user.id)
+    cached = cache.get(key)
+    if cached == FEW:
+        return set(liked.filter(message__in=message_ids))
+    if cached is None: # is it a power user?
+        threshold = getattr(settings, 'GLASS_LIKED_CACHE_MIN', 1000)
+        some = list(liked[:threshold])
+        if len(some) < threshold: # that's all of them
+            cache.set(key, FEW)
+            return message_ids.intersection(some)
+        cached = array.array('q', sorted(liked))
+        cache.set(key, cached)
+    return {i for i in message_ids if contains(cached, i)}
+
+def contains(ids, message_id):
+    i = bisect.bisect_left(ids, message_id)
+    return i < len(ids) and ids[i] == message_id
+
+def forget_liked(user_ids):
+    """
+    Drop cached sets of liked messages of users with given ids, they are
+    fetched again when needed.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.delete_many([liked_key(i) for i in user_ids])
+
+class LikedMessages():
+    """
+    Messages ‘user’ likes among given ‘messages’, fetched at once. This can
+    be passed to ‘like_badge’ tag.
+    """
+
+    def __init__(self, user, messages):
+        self.ids = liked_ids(user, (m.id for m in messages if m))
+
+    def liked(self, message):
+        return message.id in self.ids
+
+class PendingLike():
+    """
+    Like toggled during its window, not written yet.
+    """
+
+    def __init__(self, message, user, liked, count, deadline):
+        self.message  = message
+        self.user     = user
+        self.initial  = liked # state in data base
+        self.liked    = liked # state to write
+        self.count    = count
+        self.deadline = deadline
+
+    def toggle(self):
+        """
+        Toggle predicted state of the like, return it as (liked, count).
+        """
+        self.liked = not self.liked
+        self.count += 1 if self.liked else -1
+        return self.liked, self.count
+
+class LikeCoalescer():
+    """
+    Collection of pending likes of this process, flushed by timer.
+    """
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.pending = {} # (message id, user id) → ‘PendingLike’
+        self.timer   = None
+
+    def toggle(self, message, user, window):
+        key = (message.id, user.id)
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is not None:
+                return pending.toggle()
+        # queries go outside of the lock, so they don't hold other toggles
+        liked = message.likers.filter(id=user.id).exists()
+        count = message.likes()
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None: # not started by concurrent toggle meanwhile
+                pending = PendingLike(message, user, liked, count,
+                                      time.time() + window)
+                self.pending[key] = pending
+                self.schedule(window)
+            return pending.toggle()
+
+    def schedule(self, delay):
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """
+        Write likes whose window is over, reschedule for the rest. Failure
+        to write one like doesn't prevent writing the others.
+        """
+        now = time.time()
+        with self.lock:
+            self.timer = None
+            ready = [k for k, p in self.pending.items() if p.deadline <= now]
+            ready = [self.pending.pop(k) for k in ready]
+            if self.pending:
+                soonest = min(p.deadline for p in self.pending.values())
+                self.schedule(max(0, soonest - now))
+        try:
+            for pending in ready:
+                if pending.liked == pending.initial:
+                    continue
+                try:
+                    write_like(pending.message, pending.user, pending.liked)
+                except Exception:
+                    logger.exception("Failed to write like of message %s "
+                                     "by user %s", pending.message.id,
+                                     pending.user.id)
+        finally:
+            connection.close() # this thread's own connection
+
+coalescer = LikeCoalescer()
+
+def write_like(message, user, liked=None):
+    liked, count = message.toggle_like(user, liked)
+    forget_liked([user.id])
+    return liked, count
+
+def toggle_like(message, user):
+    """
+    Toggle like of ‘message’ by ‘user’, return tuple: whether the user likes
+    the message and number of likes. Depending on settings the write may be
+    postponed and coalesced with following toggles.
+    """
+    window = getattr(settings, 'GLASS_LIKE_COALESCE_WINDOW', 0)
+    if window > 0:
+        return coalescer.toggle(message, user, window)
+    return write_like(message, user)
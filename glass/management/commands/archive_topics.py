@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Management command to archive topics nobody has touched for a long time
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import itertools
+import multiprocessing
+import os
+
+from django.conf                 import settings
+from django.contrib.auth.models  import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers    import reverse
+from django.db                   import connections
+from django.http                 import HttpRequest
+from django.template.loader      import render_to_string
+from django.utils                import timezone
+from glass.archive               import archive_root, save_snapshot
+from glass.archive               import forget_snapshots
+from glass.context               import MESSAGES_PLACEHOLDER, last_message_id
+from glass.context               import stream_messages
+from glass.forms                 import MessageForm
+from glass.models                import Topic
+
+def render_snapshot(topic):
+    """
+    Generate page of ‘topic’ with all its messages as seen by anonymous
+    user, in parts (see ‘views.stream_topic’).
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = reverse('topic', args=[topic.slug])
+    request.user = AnonymousUser()
+    last_id = last_message_id(topic)
+    page = render_to_string('glass/topic.html',
+                            {'topic':    topic,
+                             'form':     MessageForm(),
+                             'stream':   True,
+                             'snapshot': True,
+                             'last_id':  last_id},
+                            request=request)
+    head, tail = page.split(MESSAGES_PLACEHOLDER, 1)
+    return itertools.chain([head],
+                           stream_messages(topic, request.user, last_id),
+                           [tail])
+
+def archive_topic(topic_id):
+    """
+    Save snapshot of topic ‘topic_id’ and mark it archived. Return whether
+    the topic is archived: if it changes while its snapshot is rendered,
+    the snapshot is deleted.
+    """
+    topic = Topic.objects.get(id=topic_id)
+    save_snapshot(topic.slug, render_snapshot(topic))
+    archived = Topic.objects.filter(id=topic.id, version=topic.version)\
+                            .update(archived=True)
+    if not archived:
+        forget_snapshots([topic.slug])
+    return bool(archived)
+
+def archive_batch(topic_ids):
+    """
+    Archive topics with given ids, return how many are archived. This runs
+    in worker processes.
+    """
+    return sum(archive_topic(topic_id) for topic_id in topic_ids)
+
+class Command(BaseCommand):
+
+    help = ("Archive topics that haven't changed for a long time: save "
+            "their pages into GLASS_ARCHIVE_ROOT, so they are served to "
+            "anonymous users without data base queries.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings,
+                                            'GLASS_ARCHIVE_AFTER_DAYS', 365),
+                            help="archive topics without new messages for "
+                            "this many days")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            dest='batch_size',
+                            help="how many topics a worker archives at once")
+        parser.add_argument('--workers', type=int, default=None,
+                            dest='workers',
+                            help="number of worker processes "
+                            "(default is number of CPUs)")
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help="render snapshots of archived topics again "
+                            "(dates on pages are relative to current day)")
+
+    def batches(self, days, batch_size, everything):
+        """
+        Generate lists of ids of topics to archive.
+        """
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+        topics = Topic.objects.filter(last_posted__lt=cutoff).order_by('id')
+        if not everything:
+            topics = topics.filter(archived=False)
+        last_id = 0
+        while True:
+            batch = list(topics.filter(id__gt=last_id)
+                               .values_list('id', flat=True)[:batch_size])
+            if not batch:
+                return
+            last_id = batch[-1]
+            yield batch
+
+    def handle(self, *args, **options):
+        if not archive_root():
+            raise CommandError("GLASS_ARCHIVE_ROOT is not set.")
+        os.makedirs(archive_root(), exist_ok=True)
+        batches = list(self.batches(options['days'],
+                                    options['batch_size'],
+                                    options['all']))
+        connections.close_all() # workers must not share connections
+        pool = multiprocessing.Pool(options['workers'])
+        try:
+            total = sum(pool.imap_unordered(archive_batch, batches))
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write("{} topics archived.".format(total))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Management command to build search index from scratch
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from glass.models                import Topic, Message
+from glass.search                import get_backend
+
+class Command(BaseCommand):
+
+    help = ("Index all topics and messages for full-text search. Documents "
+            "are replaced one chunk at a time, so search keeps working.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            dest='chunk_size',
+                            help="how many objects to index at once")
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        topics = Topic.objects.only('id', 'title')
+        messages = Message.objects.only('id', 'topic', 'content')
+        total  = self.index(topics, backend.index_topics, options['chunk_size'])
+        total += self.index(messages, backend.index_messages,
+                            options['chunk_size'])
+        with transaction.atomic():
+            backend.remove_orphans()
+        self.stdout.write("{} documents indexed.".format(total))
+
+    def index(self, objects, index_fnc, chunk_size):
+        """
+        Pass ‘objects’ to ‘index_fnc’ in chunks. Return total number of
+        objects.
+        """
+        total = 0
+        last_id = 0
+        while True:
+            chunk = list(objects.filter(id__gt=last_id)
+                                .order_by('id')[:chunk_size])
+            if not chunk:
+                return total
+            with transaction.atomic():
+                index_fnc(chunk)
+            total += len(chunk)
+            last_id = chunk[-1].id
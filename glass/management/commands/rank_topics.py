@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Management command to recalculate ratings of topics
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from django.db.models            import Min
+from glass.models                import Topic, Message, TagRating
+from glass.models                import hot_score, touch_topics, touch_index
+from glass.models                import update_rows
+from glass.signals               import SCORES
+
+class Command(BaseCommand):
+
+    help = "Recalculate initial messages, ratings and hot scores of all " \
+           "topics, including scores per tag."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            dest='chunk_size',
+                            help="how many topics to process at once")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+        changed = 0
+        while True:
+            topics = list(Topic.objects.filter(id__gt=last_id)
+                                       .order_by('id')
+                                       .values('id',
+                                               'first_message',
+                                               'created',
+                                               'rating',
+                                               'hot',
+                                               'last_posted')[:chunk_size])
+            if not topics:
+                break
+            ids = [topic['id'] for topic in topics]
+            firsts = dict(Message.objects.filter(topic__in=ids)
+                                         .order_by()
+                                         .values('topic')
+                                         .annotate(first=Min('id'))
+                                         .values_list('topic', 'first'))
+            likes = dict(Message.objects.filter(id__in=firsts.values())
+                                        .values_list('id', 'like_count'))
+            tags = Topic.tags.through.objects.filter(topic__in=ids)\
+                                             .values_list('topic', 'tag')
+            scores = {}
+            touched = {} # topics whose pages change
+            rescored = {} # topics whose scores change only
+            for topic in topics:
+                topic_id = topic['id']
+                first = firsts.get(topic_id)
+                rating = likes.get(first, 0)
+                scores[topic_id] = {'rating':      rating,
+                                    'hot':         hot_score(rating,
+                                                             topic['created']),
+                                    'last_posted': topic['last_posted']}
+                fields = {name: scores[topic_id][name]
+                          for name in ('rating', 'hot')
+                          if topic[name] != scores[topic_id][name]}
+                if topic['first_message'] != first:
+                    fields['first_message'] = first
+                    touched[topic_id] = fields
+                elif fields:
+                    rescored[topic_id] = fields
+            with transaction.atomic():
+                changed += update_rows(Topic, touched, touch_topics)
+                changed += update_rows(Topic, rescored)
+                self.sync_tag_ratings(ids, tags, scores)
+            total += len(ids)
+            last_id = ids[-1]
+        if changed:
+            touch_index()
+        self.stdout.write("{} topics ranked, {} changed."
+                          .format(total, changed))
+
+    def sync_tag_ratings(self, ids, tags, scores):
+        """
+        Make ‘TagRating’ objects of topics with given ‘ids’ agree with their
+        ‘tags’ (pairs of topic id and tag) and ‘scores’, writing only those
+        that differ.
+        """
+        wanted = set(tags)
+        stale = []
+        drifted = {}
+        for row in TagRating.objects.filter(topic__in=ids)\
+                                    .values('id', 'topic', 'tag', *SCORES):
+            key = (row['topic'], row['tag'])
+            if key not in wanted:
+                stale.append(row['id'])
+                continue
+            wanted.remove(key)
+            fields = {name: value
+                      for name, value in scores[row['topic']].items()
+                      if row[name] != value}
+            if fields:
+                drifted[row['id']] = fields
+        if stale:
+            TagRating.objects.filter(id__in=stale).delete()
+        update_rows(TagRating, drifted)
+        TagRating.objects.bulk_create(
+            TagRating(topic_id=topic_id, tag_id=tag, **scores[topic_id])
+            for topic_id, tag in wanted)
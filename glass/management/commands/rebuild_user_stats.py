@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Management command to rebuild statistics of users from scratch
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.contrib.auth.models  import User
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from django.db.models            import Count, Max, Sum
+from glass.models                import Topic, Message, UserStats
+
+class Command(BaseCommand):
+
+    help = "Recalculate statistics of all users."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            dest='chunk_size',
+                            help="how many users to process at once")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(User.objects.filter(id__gt=last_id)
+                                   .order_by('id')
+                                   .values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            posted = Message.objects.filter(author__in=ids)\
+                                    .order_by()\
+                                    .values('author')\
+                                    .annotate(messages=Count('id'),
+                                              likes=Sum('like_count'),
+                                              last_active=Max('created'))
+            started = dict(Topic.objects.filter(first_message__author__in=ids)
+                                        .order_by()
+                                        .values('first_message__author')
+                                        .annotate(n=Count('id'))
+                                        .values_list('first_message__author',
+                                                     'n'))
+            stats = {user_id: UserStats(user_id=user_id) for user_id in ids}
+            for row in posted:
+                user_stats = stats[row['author']]
+                user_stats.messages    = row['messages']
+                user_stats.likes       = row['likes'] or 0
+                user_stats.last_active = row['last_active']
+            for user_id, n in started.items():
+                stats[user_id].topics = n
+            with transaction.atomic():
+                UserStats.objects.filter(user__in=ids).delete()
+                UserStats.objects.bulk_create(stats.values())
+            total += len(ids)
+            last_id = ids[-1]
+        self.stdout.write("Statistics of {} users rebuilt.".format(total))
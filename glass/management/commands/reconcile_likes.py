@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Management command to reconcile denormalized counters of likes
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from django.db.models            import Count, Max, F, Q
+from glass.likes                 import forget_liked
+from glass.models                import Topic, Message, TagRating
+from glass.models                import hot_score, touch_topics, touch_index
+from glass.models                import update_rows
+
+class Command(BaseCommand):
+
+    help = "Make sure that counters of likes agree with actual likes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            dest='chunk_size',
+                            help="size of range of message ids to check at once")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        fixed  = self.reconcile_messages(chunk_size)
+        fixed += self.reconcile_topics(chunk_size)
+        if fixed:
+            touch_index()
+        self.stdout.write("{} counters fixed.".format(fixed))
+
+    def reconcile_messages(self, chunk_size):
+        """
+        Check ‘like_count’ of messages against actual likes, ‘chunk_size’
+        ids at once. Return number of fixed messages.
+        """
+        through = Message.likers.through
+        max_id = Message.objects.aggregate(m=Max('id'))['m'] or 0
+        fixed = 0
+        for lo in range(0, max_id + 1, chunk_size):
+            hi = lo + chunk_size
+            actual = dict(through.objects.filter(message__gte=lo,
+                                                 message__lt=hi)
+                                         .values('message')
+                                         .annotate(n=Count('id'))
+                                         .values_list('message', 'n'))
+            stored = Message.objects.filter(id__gte=lo, id__lt=hi)\
+                                    .values_list('id', 'like_count')
+            drifted = {msg_id: {'like_count': actual.get(msg_id, 0)}
+                       for msg_id, count in stored
+                       if count != actual.get(msg_id, 0)}
+            if not drifted:
+                continue
+            # numbers of likes show on topic pages, but only in like badges,
+            # which are not part of cached fragments of messages
+            with transaction.atomic():
+                update_rows(Message, drifted)
+                touch_topics(Topic.objects.filter(message__in=list(drifted)))
+            # likes were changed behind cached sets of likes
+            forget_liked(through.objects.filter(message__in=list(drifted))
+                                        .values_list('user', flat=True)
+                                        .distinct())
+            fixed += len(drifted)
+        return fixed
+
+    def reconcile_topics(self, chunk_size):
+        """
+        Check ‘rating’ of topics against ‘like_count’ of their initial
+        messages, and ratings per tag against ‘rating’ of topics,
+        ‘chunk_size’ ids at once. Return number of fixed objects. Ratings
+        don't show on pages of topics, so the topics are not touched.
+        """
+        max_id = Topic.objects.aggregate(m=Max('id'))['m'] or 0
+        fixed = 0
+        for lo in range(0, max_id + 1, chunk_size):
+            hi = lo + chunk_size
+            stored = Topic.objects.filter(id__gte=lo, id__lt=hi)\
+                                  .values_list('id',
+                                               'rating',
+                                               'created',
+                                               'first_message__like_count')
+            drifted = {topic_id: {'rating': count or 0,
+                                  'hot':    hot_score(count or 0, created)}
+                       for topic_id, rating, created, count in stored
+                       if rating != (count or 0)}
+            with transaction.atomic():
+                fixed += update_rows(Topic, drifted)
+            drifted = TagRating.objects\
+                .filter(topic__gte=lo, topic__lt=hi)\
+                .exclude(Q(rating=F('topic__rating')) & Q(hot=F('topic__hot')))\
+                .values_list('id', 'topic__rating', 'topic__hot')
+            with transaction.atomic():
+                fixed += update_rows(TagRating,
+                                     {tag_rating_id: {'rating': rating,
+                                                      'hot':    hot}
+                                      for tag_rating_id, rating, hot
+                                      in drifted})
+        return fixed
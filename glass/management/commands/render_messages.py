@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Management command to render content of messages as HTML
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from django.db.models            import F
+from glass.markup                import render_markdown
+from glass.models                import Message, Topic, touch_topics
+from glass.pagecache             import run_committed
+
+def render_batch(batch):
+    """
+    Render list of (id, content) pairs into list of (id, html) pairs. This
+    runs in worker processes, so it must not touch data base.
+    """
+    return [(msg_id, render_markdown(content)) for msg_id, content in batch]
+
+class Command(BaseCommand):
+
+    help = "Render content of messages that have no rendered HTML yet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            dest='batch_size',
+                            help="how many messages to render at once")
+        parser.add_argument('--workers', type=int, default=None,
+                            dest='workers',
+                            help="number of worker processes "
+                            "(default is number of CPUs)")
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help="re-render all messages")
+
+    def batches(self, batch_size, everything):
+        """
+        Generate lists of (id, content) pairs of messages to render.
+        """
+        messages = Message.objects.order_by('id')
+        if not everything:
+            messages = messages.filter(content_html='')
+        last_id = 0
+        while True:
+            batch = list(messages.filter(id__gt=last_id)
+                                 .values_list('id', 'content')[:batch_size])
+            if not batch:
+                return
+            last_id = batch[-1][0]
+            yield batch
+
+    def handle(self, *args, **options):
+        pool = multiprocessing.Pool(options['workers'])
+        total = 0
+        try:
+            batches = self.batches(options['batch_size'], options['all'])
+            for rendered in pool.imap(render_batch, batches):
+                with transaction.atomic():
+                    changed = [msg_id for msg_id, html in rendered
+                               if Message.objects.filter(id=msg_id)
+                                         .exclude(content_html=html)
+                                         .update(content_html=html,
+                                                 version=F('version') + 1)]
+                    if changed: # cached pages show old HTML
+                        topic_ids = Message.objects.filter(id__in=changed)\
+                                                   .values('topic_id')
+                        touch_topics(Topic.objects.filter(id__in=topic_ids))
+                run_committed() # cached pages are forgotten now
+                total += len(rendered)
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write("{} messages rendered.".format(total))
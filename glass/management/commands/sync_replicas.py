@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+#
+# Management command to copy SQLite data base into its stand-in replicas
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from django.conf                 import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db                   import DEFAULT_DB_ALIAS, connections
+
+class Command(BaseCommand):
+
+    help = ("Copy SQLite primary data base into SQLite files that stand in "
+            "for replicas listed in GLASS_REPLICAS (local testing only).")
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError("primary data base is not SQLite, real "
+                               "replicas are synchronized by replication")
+        for alias in settings.GLASS_REPLICAS:
+            replica = connections[alias]
+            if replica.vendor != 'sqlite':
+                raise CommandError("replica ‘{}’ is not SQLite".format(alias))
+            path = replica.settings_dict['NAME']
+            replica.close()
+            tmp = path + '.tmp'
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            # consistent snapshot even if the primary is being written:
+            primary.cursor().execute('VACUUM INTO %s', [tmp])
+            os.replace(tmp, path)
+            self.stdout.write("{} → {}".format(alias, path))
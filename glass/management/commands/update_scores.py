@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Management command to update scores of recently changed topics
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+from django.db.models            import F, Q
+from django.utils                import timezone
+from glass.models                import Topic, TagRating
+from glass.models                import hot_score, touch_index, update_rows
+
+class Command(BaseCommand):
+
+    help = ("Update hot scores of topics changed recently and copy scores "
+            "of these topics into scores per tag. Run this periodically, "
+            "more often than --window.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=15,
+                            help="process topics changed in this many "
+                            "last minutes")
+        parser.add_argument('--all', action='store_true', default=False,
+                            help="process all topics")
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            dest='chunk_size',
+                            help="how many topics to process at once")
+
+    def handle(self, *args, **options):
+        topics = Topic.objects.all()
+        if not options['all']:
+            window = datetime.timedelta(minutes=options['window'])
+            topics = topics.filter(modified__gte=timezone.now() - window)
+        topics = topics.order_by('id')\
+                       .values_list('id', 'rating', 'created', 'hot')
+        last_id = 0
+        updated = 0
+        while True:
+            chunk = list(topics.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            ids = [topic_id for topic_id, rating, created, hot in chunk]
+            changed = {topic_id: {'hot': hot_score(rating, created)}
+                       for topic_id, rating, created, hot in chunk
+                       if hot != hot_score(rating, created)}
+            with transaction.atomic():
+                # scores don't show on pages of topics, so the topics are
+                # not touched
+                updated += update_rows(Topic, changed)
+                drifted = TagRating.objects\
+                    .filter(topic__in=ids)\
+                    .exclude(Q(hot=F('topic__hot')) &
+                             Q(last_posted=F('topic__last_posted')))\
+                    .values_list('id', 'topic__hot', 'topic__last_posted')
+                synced = update_rows(TagRating,
+                                     {tag_rating_id: {'hot': hot,
+                                                      'last_posted': last_posted}
+                                      for tag_rating_id, hot, last_posted
+                                      in drifted})
+            if changed or synced:
+                touch_index()
+            last_id = ids[-1]
+        self.stdout.write("{} topics updated.".format(updated))
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+#
+# Rendering of markup used in messages
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bleach
+import markdown
+
+GOODISH_TAGS = ['p','kbd','br'] + bleach.ALLOWED_TAGS
+
+def render_markdown(value):
+    """
+    Render markdown ‘value’ as sanitized HTML that is safe to include into
+    pages as is.
+    """
+    return bleach.clean(markdown.markdown(value), tags=GOODISH_TAGS)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#
+# Collection of performance metrics in Prometheus format
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+‘MetricsMiddleware’ records latency of requests and number and duration
+of SQL queries per view (name of URL pattern), template tags registered
+with ‘time_tags’ record time of their rendering. Everything is served in
+Prometheus text format by ‘metrics’ view.
+
+Every process keeps its metrics in memory. When ‘GLASS_METRICS_DIR’ is set,
+processes also dump their metrics into that directory (one file per
+process, at most every ‘GLASS_METRICS_FLUSH_INTERVAL’ seconds) and the
+view sums metrics of all processes, so it works with preforking servers.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db   import connections
+from django.http import HttpResponse, Http404
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RENDER_BUCKETS  = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+METRICS = {
+    'glass_request_duration_seconds':
+    ('histogram', 'view', LATENCY_BUCKETS, "Latency of requests per view."),
+    'glass_sql_queries_total':
+    ('counter', 'view', None, "Number of SQL queries per view."),
+    'glass_sql_duration_seconds_total':
+    ('counter', 'view', None, "Time spent in SQL queries per view."),
+    'glass_template_render_seconds':
+    ('histogram', 'tag', RENDER_BUCKETS, "Rendering time per template tag."),
+    'glass_writes_throttled_total':
+    ('counter', 'view', None, "Writes rejected by per-user rate limit."),
+    'glass_writes_shed_total':
+    ('counter', 'view', None, "Writes rejected because of overload."),
+}
+
+class Registry():
+    """
+    Thread-safe storage of metrics of current process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {} # (metric, label value) → number or histogram
+        self.flushed = 0
+
+    def inc(self, metric, label, amount=1):
+        with self.lock:
+            key = (metric, label)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, metric, label, value):
+        buckets = METRICS[metric][2]
+        with self.lock:
+            key = (metric, label)
+            histogram = self.values.get(key)
+            if histogram is None: # counts per bucket, +Inf, sum
+                histogram = self.values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-2] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return [[metric, label, list(value) if isinstance(value, list) else value]
+                    for (metric, label), value in self.values.items()]
+
+    def flush(self, force=False):
+        """
+        Dump metrics into file of this process if it's time to do so.
+        """
+        directory = getattr(settings, 'GLASS_METRICS_DIR', None)
+        interval = getattr(settings, 'GLASS_METRICS_FLUSH_INTERVAL', 1)
+        now = time.time()
+        if not directory or (not force and now - self.flushed < interval):
+            return
+        self.flushed = now
+        path = os.path.join(directory, 'metrics-{}.json'.format(os.getpid()))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+registry = Registry()
+
+def collect():
+    """
+    Return metrics of all processes merged together.
+    """
+    directory = getattr(settings, 'GLASS_METRICS_DIR', None)
+    snapshots = [registry.snapshot()]
+    if directory:
+        own = os.path.join(directory, 'metrics-{}.json'.format(os.getpid()))
+        for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                pass # the process is writing it right now
+    merged = {}
+    for snapshot in snapshots:
+        for metric, label, value in snapshot:
+            key = (metric, label)
+            if isinstance(value, list):
+                old = merged.get(key, [0] * len(value))
+                merged[key] = [a + b for a, b in zip(old, value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+def render_metrics(merged):
+    """
+    Render merged metrics in Prometheus text format.
+    """
+    lines = []
+    for metric, (kind, label_name, buckets, help_text) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for (m, label), value in sorted(merged.items()):
+            if m != metric:
+                continue
+            label = '{}="{}"'.format(label_name, label)
+            if kind == 'counter':
+                lines.append('{}{{{}}} {}'.format(metric, label, value))
+                continue
+            total = 0
+            for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                total += count
+                lines.append('{}_bucket{{{},le="{}"}} {}'
+                             .format(metric, label, bound, total))
+            lines.append('{}_sum{{{}}} {}'.format(metric, label, value[-1]))
+            lines.append('{}_count{{{}}} {}'.format(metric, label, total))
+    return '\n'.join(lines) + '\n'
+
+def metrics(request):
+    """
+    Serve metrics in Prometheus text format. This is only available from
+    addresses listed in ‘GLASS_METRICS_ALLOWED_IPS’ (none by default).
+    """
+    allowed = getattr(settings, 'GLASS_METRICS_ALLOWED_IPS', [])
+    if request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404
+    return HttpResponse(render_metrics(collect()),
+                        content_type='text/plain; version=0.0.4')
+
+class CountedCursor():
+    """
+    Cursor that adds number and duration of queries it executes to
+    ‘counts’ (list of two numbers). It's much cheaper than logging every
+    query with ‘force_debug_cursor’.
+    """
+
+    def __init__(self, cursor, counts):
+        self.cursor = cursor
+        self.counts = counts
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def execute(self, sql, params=None):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(self.cursor.executemany, sql, param_list)
+
+    def timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.counts[0] += 1
+            self.counts[1] += time.perf_counter() - start
+
+def count_queries(connection):
+    """
+    Make cursors of ‘connection’ count their queries in ‘glass_sql’
+    attribute of the connection (connections are per thread). Counters only
+    grow, requests remember where they started.
+    """
+    if hasattr(connection, 'glass_sql'):
+        return
+    counts = connection.glass_sql = [0, 0.0]
+    cursor = connection.cursor
+    def counted_cursor():
+        return CountedCursor(cursor(), counts)
+    connection.cursor = counted_cursor
+
+class RecordOnClose():
+    """
+    Content of streamed response that calls ‘record’ when it's closed (the
+    server closes response once the last chunk is sent).
+    """
+
+    def __init__(self, content, record):
+        self.content = content
+        self.record = record
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        self.record()
+
+class MetricsMiddleware():
+    """
+    Record latency and SQL queries of every request. This should go first
+    in ‘MIDDLEWARE_CLASSES’. Streamed responses are recorded when they are
+    closed, so their queries are included.
+    """
+
+    def process_request(self, request):
+        request._metrics_start = time.perf_counter()
+        request._metrics_counted = {}
+        for connection in connections.all():
+            count_queries(connection)
+            request._metrics_counted[connection.alias] = \
+                tuple(connection.glass_sql)
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None: # some middleware answered before us
+            return response
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unresolved'
+        if response.streaming:
+            response.streaming_content = RecordOnClose(
+                response.streaming_content,
+                lambda: self.record(request, view, start))
+        else:
+            self.record(request, view, start)
+        return response
+
+    def record(self, request, view, start):
+        registry.observe('glass_request_duration_seconds',
+                         view,
+                         time.perf_counter() - start)
+        queries = 0
+        duration = 0.0
+        for connection in connections.all():
+            count_queries(connection)
+            started = request._metrics_counted.get(connection.alias, (0, 0.0))
+            queries += connection.glass_sql[0] - started[0]
+            duration += connection.glass_sql[1] - started[1]
+        registry.inc('glass_sql_queries_total', view, queries)
+        registry.inc('glass_sql_duration_seconds_total', view, duration)
+        registry.flush()
+
+def time_tags(library):
+    """
+    Make all tags of template ‘library’ record time of their rendering.
+    """
+    for name, compile_fnc in list(library.tags.items()):
+        library.tags[name] = timed_compile(name, compile_fnc)
+
+def timed_compile(name, compile_fnc):
+    def compile(parser, token):
+        node = compile_fnc(parser, token)
+        render = node.render
+        def timed_render(context):
+            start = time.perf_counter()
+            try:
+                return render(context)
+            finally:
+                registry.observe('glass_template_render_seconds',
+                                 name,
+                                 time.perf_counter() - start)
+        node.render = timed_render
+        return node
+    return compile
@@ -17,9 +17,21 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from django.db                      import models
+import datetime
+import math
+
+from django.conf                    import settings
+from django.core.urlresolvers       import reverse
+from django.db                      import IntegrityError, connections
+from django.db                      import models, router, transaction
+from django.db.models               import F, Value, Case, When
 from django.contrib.auth.models     import User
 from django.template.defaultfilters import slugify
+from django.utils                   import timezone
+from glass.archive                  import archive_root, forget_snapshots
+from glass.markup                   import render_markdown
+from glass.pagecache                import forget_index, forget_pages
+from glass.pagecache                import get_cache as page_cache
 
 class Tag(models.Model):
 
@@ -30,48 +42,202 @@ class Tag(models.Model):
 
 class Topic(models.Model):
 
-    title = models.CharField(max_length=128)
-    slug  = models.SlugField(unique=True)
-    tags  = models.ManyToManyField(Tag)
+    title         = models.CharField(max_length=128)
+    slug          = models.SlugField(unique=True)
+    tags          = models.ManyToManyField(Tag)
+    # Denormalized data that allows to order topics on data base level:
+    # first message of the topic and number of its “likes”.
+    first_message = models.ForeignKey('Message',
+                                      null=True,
+                                      editable=False,
+                                      related_name='+',
+                                      on_delete=models.SET_NULL)
+    rating        = models.PositiveIntegerField(default=0, editable=False)
+    # Incremented every time pages of the topic change, see ‘touch_topics’.
+    version       = models.PositiveIntegerField(default=0, editable=False)
+    modified      = models.DateTimeField(default=timezone.now,
+                                         editable=False,
+                                         db_index=True)
+    created       = models.DateTimeField(default=timezone.now, editable=False)
+    # Scores for other orderings: ‘hot’ (see ‘hot_score’) is recomputed by
+    # ‘update_scores’ command, ‘last_posted’ is updated with every message.
+    hot           = models.FloatField(default=0, editable=False)
+    last_posted   = models.DateTimeField(default=timezone.now, editable=False)
+    # Whether the page is served from snapshot, see ‘glass.archive’.
+    archived      = models.BooleanField(default=False, editable=False)
 
     def initial_message(self):
         """
         Return first message in the topic.
         """
-        return Message.objects.filter(topic=self)[0]
+        if self.first_message_id is None:
+            return Message.objects.filter(topic=self)[0]
+        return self.first_message
 
     def save(self, *args, **kwargs):
+        old_slug = self.slug
         self.slug = slugify(self.title)
+        adding = self._state.adding
+        if adding:
+            self.hot = hot_score(self.rating, self.created)
         models.Model.save(self, *args, **kwargs)
+        if adding:
+            touch_index()
+        else: # its title shows on index page
+            touch_topics(Topic.objects.filter(id=self.id), index=True)
+            if old_slug != self.slug:
+                forget_topics([old_slug])
 
     def __str__(self):
         return self.slug
 
+    class Meta:
+        index_together = [['rating', 'id'],
+                          ['hot', 'id'],
+                          ['last_posted', 'id']]
+
 class Message(models.Model):
 
     author   = models.ForeignKey(User)
     topic    = models.ForeignKey(Topic)
     content  = models.TextField("Your message")
+    # Rendered ‘content’, kept up to date in ‘save’.
+    content_html = models.TextField(blank=True, editable=False)
     created  = models.DateField(auto_now_add=True)
     modified = models.DateField(auto_now=True)
     likers   = models.ManyToManyField(User, related_name='liked')
+    # Denormalized number of ‘likers’, see ‘toggle_like’.
+    like_count = models.PositiveIntegerField(default=0, editable=False)
+    # Incremented every time rendered message changes, see ‘glass.fragments’.
+    version    = models.PositiveIntegerField(default=0, editable=False)
 
     def likes(self):
         """
         How many people like this message?
         """
-        return self.likers.count()
+        return self.like_count
+
+    def toggle_like(self, user, liked=None):
+        """
+        Make ‘user’ like this message or take his “like” back if he already
+        likes it. If ‘liked’ is given, the like is put into that state
+        instead (nothing changes if it's there already). Return tuple:
+        whether the user likes the message now and new number of likes.
 
-    def editable_by(self, user):
+        The like is toggled in a short transaction together with counter of
+        likes of the message: deletion, followed by insertion only if there
+        was nothing to delete. Version of the message stays the same, since
+        number of likes is only shown in like badge, which is not part of
+        cached fragment (see ‘glass.fragments’). Denormalized counters that
+        follow (rating of topic and its tags, statistics of author) are
+        updated after the transaction, each by single atomic update, so
+        their rows are not locked meanwhile (‘reconcile_likes’ repairs them
+        if the process dies in between). Index page changes (see
+        ‘touch_index’) only with likes of initial messages.
         """
-        Can ‘user’ delete/edit this message?
+        through = Message.likers.through
+        table   = through._meta.db_table
+        columns = (through._meta.get_field('message').column,
+                   through._meta.get_field('user').column)
+        db      = router.db_for_write(through)
+        with transaction.atomic(using=db):
+            cursor = connections[db].cursor()
+            deleted = 0
+            if liked is not True:
+                cursor.execute('DELETE FROM {} WHERE {} = %s AND {} = %s'
+                               .format(table, *columns),
+                               [self.id, user.id])
+                deleted = cursor.rowcount
+            if deleted:
+                liked, delta = False, -1
+            elif liked is False:
+                delta = 0
+            else:
+                try:
+                    with transaction.atomic(using=db):
+                        cursor.execute('INSERT INTO {} ({}, {}) '
+                                       'VALUES (%s, %s)'.format(table, *columns),
+                                       [self.id, user.id])
+                    liked, delta = True, 1
+                except IntegrityError: # concurrent request of the same user
+                    liked, delta = True, 0
+            if delta:
+                Message.objects.filter(id=self.id)\
+                               .update(like_count=F('like_count') + delta)
+        self.like_count, first_message = Message.objects\
+            .values_list('like_count', 'topic__first_message')\
+            .get(id=self.id)
+        if delta:
+            initial = first_message == self.id
+            topics = Topic.objects.filter(id=self.topic_id)
+            if initial:
+                touch_topics(topics, index=True, rating=F('rating') + delta)
+                TagRating.objects.filter(topic=self.topic_id)\
+                                 .update(rating=F('rating') + delta)
+            else:
+                touch_topics(topics)
+            update_stats(self.author_id, likes=F('likes') + delta)
+        return liked, self.like_count
+
+    def editable_by(self, user, last_id=None):
+        """
+        Can ‘user’ delete/edit this message? If id of the last message in
+        the topic is already known, pass it as ‘last_id’ to save a query.
         """
-        last_in_topic = not Message.objects.filter(
-            topic=self.topic,
-            id__gt=self.id).exists()
-        self_editing = last_in_topic and self.author == user
+        if last_id is None:
+            last_in_topic = not Message.objects.filter(
+                topic=self.topic_id,
+                id__gt=self.id).exists()
+        else:
+            last_in_topic = self.id == last_id
+        self_editing = last_in_topic and self.author_id == user.id
         return self_editing or user.is_staff
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        message = super(Message, cls).from_db(db, field_names, values)
+        # remember what ‘content_html’ has been rendered from:
+        message._html_source = message.__dict__.get('content')
+        return message
+
+    def html(self):
+        """
+        Return content of the message rendered as HTML.
+        """
+        if not self.content_html:
+            return render_markdown(self.content)
+        return self.content_html
+
+    def save(self, *args, **kwargs):
+        if (not self.content_html or
+            self.content != getattr(self, '_html_source', None)):
+            self.content_html = render_markdown(self.content)
+            self._html_source = self.content
+            self.version += 1
+        adding = self._state.adding
+        models.Model.save(self, *args, **kwargs)
+        topic = Topic.objects.filter(id=self.topic_id)
+        if adding:
+            # the first message in topic becomes its initial message, this
+            # is decided by data base, in-memory topic may be out of date
+            starts_topic = topic.filter(first_message=None)\
+                                .update(first_message=self)
+            touch_topics(topic, index=True, last_posted=timezone.now())
+            update_stats(self.author_id,
+                         messages=F('messages') + 1,
+                         topics=F('topics') + int(starts_topic),
+                         last_active=datetime.date.today())
+        else:
+            touch_topics(topic)
+
+    def get_absolute_url(self):
+        """
+        URL of page of the topic that starts with this message.
+        """
+        return '{}?msg={}#{}'.format(reverse('topic', args=[self.topic.slug]),
+                                     self.id,
+                                     self.id)
+
     def modified_later(self):
         """
         Check if modification time is greater than creation time.
@@ -83,3 +249,177 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['id']
+        # messages of topic are always fetched in ranges of ids:
+        index_together = [['topic', 'id']]
+
+def hot_score(rating, created):
+    """
+    How “hot” is topic with given ‘rating’ created at ‘created’? Every
+    ‘GLASS_HOT_GRAVITY’ seconds of age are worth as much as ten times more
+    likes. The score doesn't change as time goes, newer topics just get
+    greater scores, so it only needs updating when rating changes.
+    """
+    gravity = getattr(settings, 'GLASS_HOT_GRAVITY', 45000)
+    return math.log10(max(rating, 1)) + created.timestamp() / gravity
+
+def touch_topics(topics, index=False, **fields):
+    """
+    Mark ‘topics’ (query set) as changed, so cached copies of their pages
+    become obsolete: increment their versions and update modification time.
+    Other ‘fields’ are updated by the same query. Archived topics are
+    un-archived. With ‘index’, the change shows on index page too (title,
+    tags, initial message, its likes or time of the last message), so it
+    is touched as well, see ‘touch_index’.
+
+    This is only for changes that show on pages of the topics, changes of
+    their scores alone are written by plain updates followed by
+    ‘touch_index’.
+    """
+    if archive_root():
+        fields['archived'] = False
+    count = topics.update(version=F('version') + 1,
+                          modified=timezone.now(),
+                          **fields)
+    if count:
+        if archive_root() or page_cache():
+            # this goes after the update, so ‘archive_topics’ that is saving
+            # snapshot right now either sees new version or gets it deleted
+            forget_topics(topics.values_list('slug', flat=True))
+        if index:
+            touch_index()
+    return count
+
+def touch_index():
+    """
+    Mark index page as changed: increment version of ‘IndexState’ and make
+    cached index pages stale.
+    """
+    now = timezone.now()
+    state = IndexState.objects.filter(id=IndexState.ID)
+    if not state.update(version=F('version') + 1, modified=now):
+        IndexState.objects.get_or_create(id=IndexState.ID,
+                                         defaults={'version':  1,
+                                                   'modified': now})
+    forget_index()
+
+UPDATE_BATCH = 100 # rows written by one query of ‘update_rows’
+
+def update_rows(model, values, update=None):
+    """
+    Write different values into many rows of ‘model’ with few queries.
+    ‘values’ maps primary keys of the rows to dictionaries of their new
+    field values. ‘update’ is function of query set and field values that
+    writes them, plain ‘QuerySet.update’ by default (‘touch_topics’ is
+    another option). Return number of updated rows.
+    """
+    keys = list(values)
+    count = 0
+    for i in range(0, len(keys), UPDATE_BATCH):
+        batch = keys[i:i + UPDATE_BATCH]
+        fields = {}
+        for name in {name for key in batch for name in values[key]}:
+            field = model._meta.get_field(name)
+            cases = [When(pk=key, then=Value(values[key][name],
+                                             output_field=field))
+                     for key in batch if name in values[key]]
+            fields[name] = Case(*cases, default=F(name), output_field=field)
+        rows = model.objects.filter(pk__in=batch)
+        count += update(rows, **fields) if update else rows.update(**fields)
+    return count
+
+def forget_topics(slugs):
+    """
+    Delete snapshots and cached pages of topics with given ‘slugs’.
+    """
+    slugs = list(slugs)
+    if archive_root():
+        forget_snapshots(slugs)
+    forget_pages(slugs)
+
+def update_rating(topic_id):
+    """
+    Recalculate ‘first_message’ and ‘rating’ of topic with id ‘topic_id’.
+    This is necessary when initial message of the topic has been deleted
+    (see ‘glass.signals’).
+    """
+    first_message = Message.objects.filter(topic=topic_id)\
+                                   .values_list('id', 'author', 'like_count')\
+                                   .first()
+    if first_message is None: # the topic is empty and is deleted next
+        return
+    message_id, author_id, rating = first_message
+    if not touch_topics(Topic.objects.filter(id=topic_id),
+                        index=True,
+                        first_message=message_id,
+                        rating=rating):
+        return # the topic is gone already
+    TagRating.objects.filter(topic=topic_id).update(rating=rating)
+    # its author has started the topic now:
+    update_stats(author_id, topics=F('topics') + 1)
+
+class IndexState(models.Model):
+    """
+    The only row of this table holds version and modification time of index
+    page, which validate it (see ‘glass.conditional’). They change with
+    every topic that is created or deleted and every change of topic that
+    shows on index page, see ‘touch_index’.
+    """
+
+    ID = 1 # of the row
+
+    version  = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+class TagRating(models.Model):
+    """
+    Copy of ‘Topic.rating’ per tag of the topic, so topics with given tag
+    can be ordered using an index. This is kept in sync with tags of topics
+    by signal handlers (see ‘glass.signals’).
+    """
+
+    tag    = models.ForeignKey(Tag)
+    topic  = models.ForeignKey(Topic, related_name='tag_ratings')
+    rating = models.PositiveIntegerField(default=0)
+    # copies of other scores, see ‘update_scores’ command
+    hot         = models.FloatField(default=0)
+    last_posted = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '{} in {}'.format(self.topic_id, self.tag_id)
+
+    class Meta:
+        unique_together = [['tag', 'topic']]
+        index_together  = [['tag', 'rating', 'topic'],
+                           ['tag', 'hot', 'topic'],
+                           ['tag', 'last_posted', 'topic']]
+
+class UserStats(models.Model):
+    """
+    Statistics of user shown on his profile: how many messages he has
+    posted, how many likes they have, how many topics he has started (his
+    messages are initial messages of these topics), and when he has posted
+    last time. This is updated incrementally (see ‘update_stats’) and can be
+    rebuilt with ‘rebuild_user_stats’ command.
+    """
+
+    user        = models.OneToOneField(User,
+                                       primary_key=True,
+                                       related_name='stats')
+    messages    = models.IntegerField(default=0)
+    likes       = models.IntegerField(default=0)
+    topics      = models.IntegerField(default=0)
+    last_active = models.DateField(null=True)
+
+    def __str__(self):
+        return 'stats of {}'.format(self.user_id)
+
+def update_stats(user_id, **fields):
+    """
+    Update statistics of user with id ‘user_id’, creating them if
+    necessary. Values of ‘fields’ are usually expressions like
+    ‘F('likes') + 1’.
+    """
+    stats = UserStats.objects.filter(user_id=user_id)
+    if not stats.update(**fields):
+        UserStats.objects.get_or_create(user_id=user_id)
+        stats.update(**fields)
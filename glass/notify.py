@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Waking of clients that wait for new messages
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Every process has one ‘notifier’ that remembers id of the latest message
+per topic (for as long as requests may wait, ‘GLASS_LONG_POLL_TIMEOUT’)
+and wakes requests waiting for new messages (long polling).
+Messages posted in this process are announced right away by signal
+handler. Messages posted by other processes are noticed by single thread
+that looks for new message ids every ‘GLASS_NOTIFY_INTERVAL’ seconds
+while somebody is waiting, so there is one cheap query per process, not
+per waiting client.
+"""
+
+import threading
+import time
+
+from django.conf      import settings
+from django.db        import connection
+from django.db.models import Max
+from glass.models     import Message
+
+class Notifier():
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.latest    = {} # topic id → id of the latest known message
+        self.noticed   = {} # topic id → when it was noticed
+        self.pruned    = time.monotonic()
+        self.seen      = None # the greatest message id seen by poller
+        self.waiting   = 0
+        self.poller    = None
+
+    def notify(self, topic_id, message_id):
+        """
+        Announce new message ‘message_id’ in topic ‘topic_id’.
+        """
+        with self.condition:
+            now = time.monotonic()
+            if message_id > self.latest.get(topic_id, 0):
+                self.latest[topic_id] = message_id
+                self.noticed[topic_id] = now
+            self.condition.notify_all()
+            keep = getattr(settings, 'GLASS_LONG_POLL_TIMEOUT', 30)
+            if now - self.pruned > keep:
+                self.prune(now - keep)
+                self.pruned = now
+
+    def prune(self, before):
+        """
+        Forget topics whose latest messages were noticed ‘before’, nobody
+        waits since then. Call this with the condition held.
+        """
+        for topic_id in [topic_id for topic_id, noticed in self.noticed.items()
+                         if noticed < before]:
+            del self.latest[topic_id]
+            del self.noticed[topic_id]
+
+    def latest_in(self, topic_id):
+        """
+        Return id of the latest known message in topic ‘topic_id’ or 0.
+        """
+        with self.condition:
+            return self.latest.get(topic_id, 0)
+
+    def wait(self, topic_id, since, timeout):
+        """
+        Wait at most ‘timeout’ seconds until there is a message newer than
+        ‘since’ in topic ‘topic_id’. Return whether there is one.
+        """
+        with self.condition:
+            self.waiting += 1
+            if self.poller is None:
+                self.poller = threading.Thread(target=self.poll, daemon=True)
+                self.poller.start()
+            try:
+                return self.condition.wait_for(
+                    lambda: self.latest.get(topic_id, 0) > since,
+                    timeout)
+            finally:
+                self.waiting -= 1
+
+    def poll(self):
+        """
+        Look for messages posted by other processes while there are waiting
+        requests.
+        """
+        interval = getattr(settings, 'GLASS_NOTIFY_INTERVAL', 1)
+        try:
+            if self.seen is None:
+                self.seen = Message.objects.aggregate(m=Max('id'))['m'] or 0
+            while True:
+                time.sleep(interval)
+                with self.condition:
+                    if not self.waiting:
+                        self.poller = self.seen = None
+                        return
+                new = Message.objects.filter(id__gt=self.seen)\
+                                     .order_by('id')\
+                                     .values_list('topic_id', 'id')
+                for topic_id, message_id in new:
+                    self.notify(topic_id, message_id)
+                    self.seen = message_id
+        finally:
+            with self.condition:
+                if self.poller is threading.current_thread(): # crashed
+                    self.poller = self.seen = None
+            connection.close() # this thread's own connection
+
+notifier = Notifier()
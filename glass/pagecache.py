@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Cache of whole pages for anonymous users
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Anonymous users see the same pages, so views decorated with
+‘cache_anonymous’ keep rendered pages for them in cache ‘GLASS_PAGE_CACHE’
+(which should be shared by all processes). Pages are identified by path
+and those GET parameters that change them, others (like tracking
+parameters) are ignored.
+
+Every page belongs to a “generation” — a token kept in cache: pages of
+topic belong to generation of the topic, index page to generation of all
+topics. ‘forget_pages’ and ‘forget_index’ replace tokens when topics change
+(see ‘touch_topics’ and ‘touch_index’), which makes their pages stale.
+Tokens are replaced only after the change is committed (see
+‘after_commit’), otherwise a page rendered meanwhile from old data would
+be cached under the new token. Pages are also stale after
+‘GLASS_PAGE_CACHE_TIMEOUT’ seconds.
+
+Stale page is rendered again by only one request at a time (it takes a
+lock in cache), the other requests are answered with the stale copy
+meanwhile, if it's not older than ‘GLASS_PAGE_CACHE_STALE’ seconds more.
+Without any copy they wait for the one being rendered.
+"""
+
+import functools
+import hashlib
+import random
+import threading
+import time
+
+from django.conf          import settings
+from django.core.cache    import caches
+from django.core.signals  import request_finished
+from django.db            import DEFAULT_DB_ALIAS, connections
+from django.http          import HttpResponse, HttpResponseNotModified
+from django.utils.http    import urlencode
+
+LOCK_TIMEOUT  = 30  # longest time page may take to render, seconds
+WAIT_INTERVAL = 0.1 # how often requests without any copy look for one
+KEPT_HEADERS  = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control',
+                 'Vary')
+
+def get_cache():
+    alias = getattr(settings, 'GLASS_PAGE_CACHE', None)
+    return caches[alias] if alias else None
+
+deferred = threading.local() # ‘calls’ — list of functions, see ‘after_commit’
+
+def after_commit(func):
+    """
+    Call ‘func’ once data written so far is committed: right away outside
+    of transactions, otherwise after the outermost atomic block exits (when
+    calls are run by ‘run_committed’). Django 1.8 has no ‘on_commit’ hook.
+    Calls deferred by transaction that is rolled back run as well.
+    """
+    if not hasattr(deferred, 'calls'):
+        deferred.calls = []
+    deferred.calls.append(func)
+    run_committed()
+
+def run_committed(**kwargs):
+    """
+    Run calls deferred by ‘after_commit’ unless a transaction is still open.
+    This runs at the end of every request, code that writes in transactions
+    outside of requests should call it after them.
+    """
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return
+    calls = getattr(deferred, 'calls', [])
+    while calls:
+        calls.pop(0)()
+
+request_finished.connect(run_committed,
+                         dispatch_uid='glass.pagecache.run_committed')
+
+def generation_key(name):
+    return 'glass:page-gen:{}'.format(name)
+
+def new_token():
+    return '{:016x}'.format(random.getrandbits(64))
+
+def generation(cache, name):
+    """
+    Return current token of generation ‘name’.
+    """
+    key = generation_key(name)
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, new_token(), None)
+        token = cache.get(key)
+    return token
+
+def index_generation(request):
+    return 'index'
+
+def topic_generation(request, slug):
+    return 'topic:{}'.format(slug)
+
+def forget_pages(slugs):
+    """
+    Make cached pages of topics with given ‘slugs’ stale.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    names = [topic_generation(None, slug) for slug in slugs]
+    after_commit(lambda: cache.set_many({generation_key(name): new_token()
+                                         for name in names},
+                                        None))
+
+def forget_index():
+    """
+    Make cached index pages stale.
+    """
+    cache = get_cache()
+    if cache is not None:
+        after_commit(lambda: cache.set(generation_key(index_generation(None)),
+                                       new_token(), None))
+
+def page_key(request, params):
+    query = urlencode(sorted((name, request.GET[name])
+                             for name in params if name in request.GET))
+    digest = hashlib.md5('{}?{}'.format(request.path, query).encode())
+    return 'glass:page:{}'.format(digest.hexdigest())
+
+def cache_anonymous(params, generation_of=None):
+    """
+    Decorator that caches responses of view for anonymous users. Only GET
+    parameters listed in ‘params’ distinguish pages. ‘generation_of’ is
+    function of request and arguments of the view that returns name of
+    generation the page belongs to, or ‘None’ if it belongs to none.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            cache = get_cache()
+            if cache is None or request.method not in ('GET', 'HEAD') or \
+               request.user.is_authenticated():
+                return view(request, *args, **kwargs)
+            name = generation_of and generation_of(request, *args, **kwargs)
+            token = name and generation(cache, name)
+            key = page_key(request, params)
+            page = cache.get(key)
+            if page is not None and page['generation'] == token and \
+               page['expires'] > time.time():
+                return cached_response(request, page)
+            lock = key + ':lock'
+            locked = cache.add(lock, True, LOCK_TIMEOUT)
+            if not locked: # somebody is rendering the page already
+                while page is None and cache.get(lock) is not None:
+                    time.sleep(WAIT_INTERVAL)
+                    page = cache.get(key)
+                if page is not None:
+                    return cached_response(request, page)
+            try:
+                response = view(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    timeout = getattr(settings, 'GLASS_PAGE_CACHE_TIMEOUT', 60)
+                    stale = getattr(settings, 'GLASS_PAGE_CACHE_STALE', 300)
+                    page = {'generation': token,
+                            'expires':    time.time() + timeout,
+                            'content':    response.content,
+                            'headers':    [(header, response[header])
+                                           for header in KEPT_HEADERS
+                                           if response.has_header(header)]}
+                    cache.set(key, page, timeout + stale)
+                return response
+            finally:
+                if locked:
+                    cache.delete(lock)
+        return wrapper
+    return decorator
+
+def cached_response(request, page):
+    headers = dict(page['headers'])
+    etag = headers.get('ETag')
+    if etag and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+        del headers['Content-Type']
+    else:
+        response = HttpResponse(page['content'])
+    for header, value in headers.items():
+        response[header] = value
+    return response
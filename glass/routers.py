@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Routing of queries to read replicas
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reads of read-only requests go to replicas listed in ‘GLASS_REPLICAS’
+(aliases from ‘DATABASES’), everything else goes to ‘default’ data base,
+which is the primary.
+
+‘ReplicaMiddleware’ decides for every request: safe requests (GET, HEAD)
+read from one replica picked at random, unless the view is decorated with
+‘use_primary’ or the user wrote something recently. Once a request writes
+to data base (it's unsafe, its view is decorated with ‘writes’ or it saves
+objects), the rest of it reads from the primary too and the
+response sets a cookie that keeps the user on the primary for
+‘GLASS_REPLICA_STICKY_SECONDS’, so users always see their own posts
+despite replication lag.
+
+Outside of requests (management commands, shell) all queries go to the
+primary.
+"""
+
+import contextlib
+import random
+import threading
+
+from django.conf              import settings
+from django.db                import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_save
+from glass.admission          import is_write
+
+STICKY_COOKIE = 'glass_primary'
+
+state = threading.local() # ‘replica’ — alias to read from, ‘wrote’ — flag
+
+def replicas():
+    return getattr(settings, 'GLASS_REPLICAS', ())
+
+def use_primary(view):
+    """
+    Decorator for views that must see the latest data: they always read
+    from the primary. Views that write on safe requests should be decorated
+    with ‘writes’ instead.
+    """
+    view.glass_use_primary = True
+    return view
+
+@contextlib.contextmanager
+def reading_from(alias):
+    """
+    Read from data base ‘alias’ inside of the block. This is for code that
+    runs after response has left the middleware, like streamed content.
+    """
+    old = getattr(state, 'replica', None)
+    state.replica = None if alias == DEFAULT_DB_ALIAS else alias
+    try:
+        yield
+    finally:
+        state.replica = old
+
+def note_write(*args, **kwargs):
+    """
+    Remember that current request writes, so it reads its writes.
+    """
+    state.replica = None
+    state.wrote = True
+
+# deletion signals are not used: their receivers make Django fetch related
+# objects before deleting them instead of deleting them with single query
+post_save.connect(note_write, dispatch_uid='glass.routers.note_write')
+
+class ReplicaRouter():
+    """
+    Data base router sending reads to replica chosen for current request.
+    """
+
+    def db_for_read(self, model, **hints):
+        return getattr(state, 'replica', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # this is also asked when objects are merely assigned to foreign
+        # keys, so it doesn't mean anything is written (see ‘note_write’)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS,) + tuple(replicas())
+        return obj1._state.db in databases and obj2._state.db in databases
+
+class ReplicaMiddleware():
+    """
+    Choose data base to read from for every request. This should go before
+    any middleware that touches data base (sessions, authentication).
+    """
+
+    def process_request(self, request):
+        state.wrote = False
+        state.replica = None
+        if request.method in ('GET', 'HEAD') and replicas() and \
+           STICKY_COOKIE not in request.COOKIES:
+            state.replica = random.choice(replicas())
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') or \
+           is_write(request, view_func):
+            note_write()
+        elif getattr(view_func, 'glass_use_primary', False):
+            state.replica = None
+
+    def process_response(self, request, response):
+        if getattr(state, 'wrote', False) and replicas():
+            response.set_cookie(
+                STICKY_COOKIE, '1', httponly=True,
+                max_age=getattr(settings, 'GLASS_REPLICA_STICKY_SECONDS', 10))
+        state.wrote = False
+        state.replica = None
+        return response
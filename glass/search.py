@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# Full-text search in topics and messages
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Search backends index titles of topics and contents of messages. Every
+topic and every message is a separate document in the index, its key is
+derived from id of the object (see ‘topic_key’ and ‘message_key’), so
+single documents can be updated when objects are saved or deleted. Topics
+are ranked by their best matching document.
+
+Backend is selected by ‘GLASS_SEARCH_BACKEND’ setting (dotted path to a
+class), by default it's chosen according to data base vendor and what the
+data base supports (SQLite may be built without FTS5), falling back to
+substring search (‘SimpleBackend’).
+"""
+
+from django.conf        import settings
+from django.db          import DEFAULT_DB_ALIAS, DatabaseError, transaction
+from django.db          import connection, connections, router
+from django.db.models   import Q
+from django.utils       import module_loading
+from glass.models       import Topic, Message
+
+def topic_key(topic_id):
+    return topic_id * 2 + 1
+
+def message_key(message_id):
+    return message_id * 2
+
+class SearchResults():
+    """
+    Lazy ranked list of topics found by backend. This supports ‘count’ and
+    slicing, so it can be paginated, every page is fetched with separate
+    query.
+    """
+
+    def __init__(self, backend, query, tag=None, order=None):
+        self.backend = backend
+        self.query   = query
+        self.tag     = tag
+        self.order   = order
+        self._count  = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query, self.tag)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        offset = k.start or 0
+        limit  = (k.stop if k.stop is not None else self.count()) - offset
+        ids    = self.backend.ranked_ids(self.query, self.tag, limit, offset,
+                                         self.order)
+        topics = Topic.objects.select_related('first_message')\
+                              .prefetch_related('tags')\
+                              .in_bulk(ids)
+        return [topics[i] for i in ids if i in topics]
+
+class SearchBackend():
+    """
+    Base class of backends that keep their own index in data base table.
+    """
+
+    table = 'glass_search'
+
+    def __init__(self):
+        self.ready_in = None
+
+    @staticmethod
+    def supported(connection):
+        """
+        Whether data base of ‘connection’ can run this backend.
+        """
+        return True
+
+    def setup(self, cursor):
+        """
+        Create index table if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def cursor(self):
+        """
+        Return cursor of the primary data base, creating index table first
+        if necessary. The table is known to exist only once it's committed:
+        inside of transaction, which may be rolled back, this is checked
+        again every time.
+        """
+        primary = connections[DEFAULT_DB_ALIAS]
+        cursor = primary.cursor()
+        db = primary.settings_dict['NAME']
+        if self.ready_in != db:
+            self.setup(cursor)
+            if not primary.in_atomic_block:
+                self.ready_in = db
+        return cursor
+
+    def read_cursor(self):
+        """
+        Return cursor of data base to read from, it may be a replica (see
+        ‘glass.routers’) where index table is created by replication.
+        """
+        alias = router.db_for_read(Topic)
+        if alias == DEFAULT_DB_ALIAS:
+            return self.cursor()
+        return connections[alias].cursor()
+
+    def index(self, documents):
+        """
+        Put ‘documents’ (tuples of key, topic id, title, and body) into
+        index, replacing old versions of the documents.
+        """
+        raise NotImplementedError
+
+    def remove(self, keys):
+        """
+        Remove documents with given ‘keys’ from index with one query.
+        """
+        keys = list(keys)
+        if keys:
+            self.cursor().execute('DELETE FROM {} WHERE {} IN ({})'
+                                  .format(self.table, self.key_column,
+                                          ', '.join(['%s'] * len(keys))),
+                                  keys)
+
+    def clear(self):
+        """
+        Remove all documents from index.
+        """
+        self.cursor().execute('DELETE FROM {}'.format(self.table))
+
+    def remove_orphans(self):
+        """
+        Remove documents of topics and messages that don't exist anymore.
+        """
+        self.cursor().execute(
+            'DELETE FROM {0} WHERE '
+            '({1} % 2 = 1 AND {1} / 2 NOT IN (SELECT id FROM {2})) OR '
+            '({1} % 2 = 0 AND {1} / 2 NOT IN (SELECT id FROM {3}))'
+            .format(self.table, self.key_column,
+                    Topic._meta.db_table, Message._meta.db_table))
+
+    def index_topics(self, topics):
+        self.index((topic_key(t.id), t.id, t.title, '') for t in topics)
+
+    def index_messages(self, messages):
+        self.index((message_key(m.id), m.topic_id, '', m.content)
+                   for m in messages)
+
+    def remove_topic(self, topic_id):
+        self.remove([topic_key(topic_id)])
+
+    def remove_message(self, message_id):
+        self.remove([message_key(message_id)])
+
+    def remove_messages(self, message_ids):
+        self.remove(map(message_key, message_ids))
+
+    def search(self, query, tag=None, order=None):
+        """
+        Return topics matching ‘query’ (and having ‘tag’ if it's given) as
+        ‘SearchResults’. Topics are ranked by relevance or by field of topic
+        named ‘order’ (descending).
+        """
+        if not query.split():
+            return []
+        return SearchResults(self, query, tag, order)
+
+    def order_join(self, order):
+        """
+        Return SQL join and expression to order results by field of topic
+        named ‘order’.
+        """
+        column = Topic._meta.get_field(order).column
+        return ('JOIN {} t ON t.id = s.topic_id'.format(Topic._meta.db_table),
+                'MAX(t.{}) DESC'.format(column))
+
+    def tag_join(self, tag):
+        """
+        Return SQL join and parameters that restrict results to topics with
+        given ‘tag’.
+        """
+        if not tag:
+            return '', []
+        through = Topic.tags.through
+        return ('JOIN {} tt ON tt.topic_id = s.topic_id AND tt.tag_id = %s'
+                .format(through._meta.db_table), [tag])
+
+    def fetch_ids(self, sql, params):
+        cursor = self.read_cursor()
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+class SQLiteBackend(SearchBackend):
+    """
+    Search using FTS5 extension of SQLite.
+    """
+
+    key_column = 'rowid'
+
+    @staticmethod
+    def supported(connection):
+        """
+        FTS5 may be missing from SQLite, try to create a table with it.
+        """
+        try:
+            with transaction.atomic(using=connection.alias), \
+                 connection.cursor() as cursor:
+                cursor.execute('CREATE VIRTUAL TABLE temp.glass_fts5_check '
+                               'USING fts5(body)')
+                cursor.execute('DROP TABLE temp.glass_fts5_check')
+        except DatabaseError:
+            return False
+        return True
+
+    def setup(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s",
+                       [self.table])
+        if cursor.fetchone():
+            return
+        cursor.execute('CREATE VIRTUAL TABLE {} '
+                       'USING fts5(title, body, topic_id UNINDEXED)'
+                       .format(self.table))
+        # matches in titles are more important:
+        cursor.execute("INSERT INTO {0}({0}, rank) "
+                       "VALUES ('rank', 'bm25(10.0, 1.0)')"
+                       .format(self.table))
+
+    def index(self, documents):
+        documents = list(documents)
+        self.remove(d[0] for d in documents)
+        self.cursor().executemany(
+            'INSERT INTO {} (rowid, topic_id, title, body) '
+            'VALUES (%s, %s, %s, %s)'.format(self.table),
+            documents)
+
+    @staticmethod
+    def match(query):
+        """
+        Turn user's query into FTS5 query: every word must be present.
+        """
+        return ' '.join('"{}"'.format(w.replace('"', '""'))
+                        for w in query.split())
+
+    def count(self, query, tag):
+        join, params = self.tag_join(tag)
+        return self.fetch_ids(
+            'SELECT COUNT(DISTINCT s.topic_id) FROM '
+            '(SELECT topic_id FROM {0} WHERE {0} MATCH %s) s {1}'
+            .format(self.table, join),
+            [self.match(query)] + params)[0]
+
+    def ranked_ids(self, query, tag, limit, offset, order=None):
+        join, params = self.tag_join(tag)
+        ordering = 'MIN(s.rank)'
+        if order:
+            order_join, ordering = self.order_join(order)
+            join += ' ' + order_join
+        return self.fetch_ids(
+            'SELECT s.topic_id FROM '
+            '(SELECT topic_id, rank FROM {0} WHERE {0} MATCH %s) s {1} '
+            'GROUP BY s.topic_id ORDER BY {2}, s.topic_id DESC '
+            'LIMIT %s OFFSET %s'.format(self.table, join, ordering),
+            [self.match(query)] + params + [limit, offset])
+
+class PostgreSQLBackend(SearchBackend):
+    """
+    Search using native text search of PostgreSQL.
+    """
+
+    key_column = 'key'
+
+    def setup(self, cursor):
+        cursor.execute('CREATE TABLE IF NOT EXISTS {0} ('
+                       'key bigint PRIMARY KEY, '
+                       'topic_id integer NOT NULL, '
+                       'document tsvector NOT NULL)'.format(self.table))
+        cursor.execute('CREATE INDEX IF NOT EXISTS {0}_document '
+                       'ON {0} USING gin(document)'.format(self.table))
+        cursor.execute('CREATE INDEX IF NOT EXISTS {0}_topic '
+                       'ON {0} (topic_id)'.format(self.table))
+
+    def index(self, documents):
+        documents = list(documents)
+        self.remove(d[0] for d in documents)
+        self.cursor().executemany(
+            'INSERT INTO {} (key, topic_id, document) VALUES (%s, %s, '
+            "setweight(to_tsvector(%s), 'A') || to_tsvector(%s))"
+            .format(self.table),
+            documents)
+
+    def count(self, query, tag):
+        join, params = self.tag_join(tag)
+        return self.fetch_ids(
+            'SELECT COUNT(DISTINCT s.topic_id) FROM {} s {} '
+            'WHERE s.document @@ plainto_tsquery(%s)'
+            .format(self.table, join),
+            params + [query])[0]
+
+    def ranked_ids(self, query, tag, limit, offset, order=None):
+        join, params = self.tag_join(tag)
+        ordering = 'MAX(ts_rank(s.document, q)) DESC'
+        if order:
+            order_join, ordering = self.order_join(order)
+            join += ' ' + order_join
+        return self.fetch_ids(
+            'SELECT s.topic_id FROM {} s {}, plainto_tsquery(%s) q '
+            'WHERE s.document @@ q GROUP BY s.topic_id '
+            'ORDER BY {}, s.topic_id DESC '
+            'LIMIT %s OFFSET %s'.format(self.table, join, ordering),
+            params + [query, limit, offset])
+
+class SimpleBackend():
+    """
+    Fallback for data bases without full-text search: no index, just
+    inefficient substring search ordered by rating.
+    """
+
+    def index_topics(self, topics):
+        pass
+
+    def index_messages(self, messages):
+        pass
+
+    def remove_topic(self, topic_id):
+        pass
+
+    def remove_message(self, message_id):
+        pass
+
+    def remove_messages(self, message_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def remove_orphans(self):
+        pass
+
+    def search(self, query, tag=None, order=None):
+        topics = Topic.objects.select_related('first_message')\
+                              .prefetch_related('tags')\
+                              .filter(Q(title__icontains=query) |
+                                      Q(message__content__icontains=query))
+        if tag:
+            topics = topics.filter(tags=tag)
+        return topics.distinct().order_by('-' + (order or 'rating'), '-id')
+
+VENDOR_BACKENDS = {'sqlite':     SQLiteBackend,
+                   'postgresql': PostgreSQLBackend}
+
+_backend = None
+
+def get_backend():
+    """
+    Return search backend to use.
+    """
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'GLASS_SEARCH_BACKEND', None)
+        if path:
+            backend_class = module_loading.import_string(path)
+        else:
+            backend_class = VENDOR_BACKENDS.get(connection.vendor,
+                                                SimpleBackend)
+            if not backend_class.supported(connection):
+                backend_class = SimpleBackend
+        _backend = backend_class()
+    return _backend
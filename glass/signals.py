@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# Signal handlers of Glass application
+#
+# Copyright © 2015 Mark Karpov <markkarpov@openmailbox.org>
+#
+# Glass is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Glass is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from django.db.models         import F
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.db.models.signals import m2m_changed
+from django.dispatch          import receiver
+from glass                    import search
+from glass.fragments          import forget_fragment
+from glass.likes              import forget_liked, get_cache as likes_cache
+from glass.models             import Topic, Message, TagRating, UserStats
+from glass.models             import touch_topics, touch_index, forget_topics
+from glass.models             import update_rating
+from glass.notify             import notifier
+
+@receiver(post_save, sender=Topic)
+def index_topic(sender, instance, **kwargs):
+    search.get_backend().index_topics([instance])
+
+@receiver(post_delete, sender=Topic)
+def unindex_topic(sender, instance, **kwargs):
+    search.get_backend().remove_topic(instance.id)
+
+@receiver(post_delete, sender=Topic)
+def forget_topic(sender, instance, **kwargs):
+    forget_topics([instance.slug])
+    touch_index()
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    search.get_backend().index_messages([instance])
+
+@receiver(post_save, sender=Message)
+def announce_message(sender, instance, created, **kwargs):
+    if created:
+        notifier.notify(instance.topic_id, instance.id)
+
+@receiver(pre_delete, sender=Message)
+def forget_message_stats(sender, instance, **kwargs):
+    initial = Topic.objects.filter(first_message=instance).exists()
+    instance._glass_initial = initial # for ‘repair_topic’
+    # no need to create statistics here, the user may be being deleted
+    UserStats.objects.filter(user_id=instance.author_id)\
+                     .update(messages=F('messages') - 1,
+                             likes=F('likes') - instance.like_count,
+                             topics=F('topics') - int(initial))
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, **kwargs):
+    search.get_backend().remove_message(instance.id)
+
+@receiver(post_delete, sender=Message)
+def uncache_message(sender, instance, **kwargs):
+    forget_fragment(instance)
+    touch_topics(Topic.objects.filter(id=instance.topic_id))
+
+@receiver(post_delete, sender=Message)
+def repair_topic(sender, instance, **kwargs):
+    """
+    Make the next message initial message of the topic when its initial
+    message is deleted, no matter how (view, admin, shell).
+    """
+    if getattr(instance, '_glass_initial', False):
+        update_rating(instance.topic_id)
+
+SCORES = ('rating', 'hot', 'last_posted') # copied into ‘TagRating’
+
+@receiver(m2m_changed, sender=Topic.tags.through)
+def update_tag_ratings(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep ‘TagRating’ objects in agreement with tags of topics.
+    """
+    if action in ('post_add', 'post_remove'):
+        touch_topics(Topic.objects.filter(id__in=pk_set) if reverse else
+                     Topic.objects.filter(id=instance.id),
+                     index=True)
+    elif action == 'pre_clear':
+        touch_topics(Topic.objects.filter(tags=instance) if reverse else
+                     Topic.objects.filter(id=instance.id),
+                     index=True)
+    if action == 'post_add':
+        if reverse: # ‘instance’ is tag, ‘pk_set’ contains topic ids
+            scores = Topic.objects.filter(id__in=pk_set)\
+                                  .values('id', *SCORES)
+            TagRating.objects.bulk_create(
+                TagRating(tag=instance,
+                          topic_id=score.pop('id'),
+                          **score)
+                for score in scores)
+        else: # ‘instance’ is topic, ‘pk_set’ contains tag names
+            score = Topic.objects.values(*SCORES).get(id=instance.id)
+            TagRating.objects.bulk_create(
+                TagRating(tag_id=tag, topic=instance, **score)
+                for tag in pk_set)
+    elif action == 'post_remove':
+        if reverse:
+            TagRating.objects.filter(tag=instance, topic__in=pk_set).delete()
+        else:
+            TagRating.objects.filter(topic=instance, tag__in=pk_set).delete()
+    elif action == 'post_clear':
+        if reverse:
+            TagRating.objects.filter(tag=instance).delete()
+        else:
+            TagRating.objects.filter(topic=instance).delete()
+
+def forget_changed_likes(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drop cached sets of liked messages when likes are changed directly (not
+    by ‘toggle_like’, which drops them itself).
+    """
+    if action in ('post_add', 'post_remove'):
+        forget_liked([instance.id] if reverse else pk_set)
+    elif action == 'pre_clear':
+        forget_liked([instance.id] if reverse else
+                     instance.likers.values_list('id', flat=True))
+
+# only with the cache: receivers of this signal make Django fetch likes of
+# deleted messages before deleting them instead of deleting them at once
+if likes_cache() is not None:
+    m2m_changed.connect(forget_changed_likes, sender=Message.likers.through)
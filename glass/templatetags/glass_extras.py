@@ -19,11 +19,11 @@
 
 from django                   import template
 from django.core.urlresolvers import reverse
+from glass.fragments          import get_fragments, stitch
+from glass.markup             import render_markdown
+from glass.metrics            import time_tags
 from glass.models             import Tag
 
-import bleach
-import markdown
-
 register = template.Library()
 
 @register.inclusion_tag('form.html')
@@ -46,24 +46,50 @@ def generic_button(caption):
 def css_class(field, cls):
     return field.as_widget(attrs={"class":cls})
 
-@register.filter(name='markdown')
-def render_markdown(value):
-    goodish_tags = ['p','kbd','br'] + bleach.ALLOWED_TAGS
-    return bleach.clean(markdown.markdown(value), tags=goodish_tags)
+register.filter('markdown', render_markdown)
 
-@register.inclusion_tag('message.html', name='message')
-def render_message(message, user):
-    editable = message.editable_by(user)
-    return {'message': message, 'user': user, 'editable': editable}
+@register.simple_tag(name='message')
+def render_message(message, user, topic_context=None):
+    """
+    Render ‘message’ for ‘user’. If ‘topic_context’ (see
+    ‘glass.context.TopicRenderContext’) is given, it's used instead of
+    querying data base.
+    """
+    if topic_context:
+        return topic_context.render(message)
+    return stitch(get_fragments([message])[message.id],
+                  message,
+                  user,
+                  message.likers.filter(id=user.id).exists(),
+                  message.editable_by(user))
 
 @register.inclusion_tag('like-badge.html')
-def like_badge(message, user):
-    liked = message.likers.filter(username=user.username).exists()
+def like_badge(message, user, likes=None):
+    """
+    Render number of likes of ‘message’, which can be toggled by ‘user’.
+    Whether the user likes the message is asked from ‘likes’ (‘LikedMessages’
+    or ‘TopicRenderContext’) if it's given.
+    """
+    if likes:
+        liked = likes.liked(message)
+    else:
+        liked = message.likers.filter(id=user.id).exists()
     return {'message': message, 'user': user, 'liked': liked}
 
+@register.inclusion_tag('keyset-pagination.html', name='keyset_pagination')
+def render_keyset_pagination(topic_context):
+    """
+    Render links to previous and next pages of messages in topic.
+    """
+    messages = topic_context.messages
+    return {'ctx':      topic_context,
+            'first_id': messages[0].id if messages else None,
+            'last_id':  messages[-1].id if messages else None}
+
 @register.inclusion_tag('tags.html', name='tags_of')
 def render_tags(topic=None):
-    tags = Tag.objects.filter(topic=topic) if topic else Tag.objects.all()
+    # tags of topic are taken from ‘prefetch_related’ cache if it's there
+    tags = topic.tags.all() if topic else Tag.objects.all()
     return {'tags': tags}
 
 @register.simple_tag(takes_context=True)
@@ -84,7 +110,10 @@ def render_paginaiton(context):
     """
     Render selection for pagination. Hairy stuff abstracted.
 
-    Note the this tag requires 'page', 'page_range', and 'num_pages' items
-    be defined in request context.
+    Note the this tag requires 'page' and 'page_range' items be defined in
+    request context, link to the last page is shown if 'num_pages' is
+    defined too.
     """
     return context
+
+time_tags(register)
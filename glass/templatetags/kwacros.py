@@ -57,11 +57,17 @@ through {% extends ... %} tags.
 """
 
 from django import template
+from django.conf import settings
 from django.template.base import FilterExpression
 from django.template.loader import get_template
 
 register = template.Library()
 
+## Macros defined in files loaded with {% loadkwacros %}, by file name.
+## Every file is parsed only once (unless in debug mode, so changes of
+## the files are picked up).
+_loaded_macros = {}
+
 
 def _setup_macros_dict(parser):
     ## Metadata of each macro are stored in a new attribute
@@ -75,7 +81,7 @@ def _setup_macros_dict(parser):
 
 
 class DefineMacroNode(template.Node):
-    def __init__(self, name, nodelist, args):
+    def __init__(self, name, nodelist, args, parser):
 
         self.name = name
         self.nodelist = nodelist
@@ -85,8 +91,9 @@ class DefineMacroNode(template.Node):
             if "=" not in a:
                 self.args.append(a)
             else:
-                name, value = a.split("=")
-                self.kwargs[name] = value
+                ## default values are compiled once, here
+                name, value = a.split("=", 1)
+                self.kwargs[name] = FilterExpression(value, parser)
 
     def render(self, context):
         ## empty string - {% macro %} tag does no output
@@ -111,7 +118,8 @@ def do_macro(parser, token):
     ## of 'parser' class. That way we can access it later
     ## in the template when processing 'usemacro' tags.
     _setup_macros_dict(parser)
-    parser._macros[macro_name] = DefineMacroNode(macro_name, nodelist, args)
+    parser._macros[macro_name] = DefineMacroNode(macro_name, nodelist, args,
+                                                 parser)
     return parser._macros[macro_name]
 
 
@@ -131,8 +139,14 @@ def do_loadmacros(parser, token):
         raise template.TemplateSyntaxError(m)
     if filename[0] in ('"', "'") and filename[-1] == filename[0]:
         filename = filename[1:-1]
-    t = get_template(filename)
-    macros = t.nodelist.get_nodes_by_type(DefineMacroNode)
+    macros = _loaded_macros.get(filename)
+    if macros is None:
+        t = get_template(filename)
+        ## unwrap template of the backend to get to its nodes
+        t = getattr(t, 'template', t)
+        macros = t.nodelist.get_nodes_by_type(DefineMacroNode)
+        if not settings.DEBUG:
+            _loaded_macros[filename] = macros
     ## Metadata of each macro are stored in a new attribute
     ## of 'parser' class. That way we can access it later
     ## in the template when processing 'usemacro' tags.
@@ -151,22 +165,25 @@ class UseMacroNode(template.Node):
 
     def render(self, context):
 
+        ## arguments are resolved in context of the caller, but macro body
+        ## is rendered in its own context layer, so the caller's context is
+        ## not changed
+        values = {}
         for i, arg in enumerate(self.macro.args):
             try:
                 fe = self.fe_args[i]
-                context[arg] = fe.resolve(context)
+                values[arg] = fe.resolve(context)
             except IndexError:
-                context[arg] = ""
+                values[arg] = ""
 
         for name, default in iter(self.macro.kwargs.items()):
             if name in self.fe_kwargs:
-                context[name] = self.fe_kwargs[name].resolve(context)
+                values[name] = self.fe_kwargs[name].resolve(context)
             else:
-                context[name] = FilterExpression(default,
-                                                 self.macro.parser
-                ).resolve(context)
+                values[name] = default.resolve(context)
 
-        return self.macro.nodelist.render(context)
+        with context.push(**values):
+            return self.macro.nodelist.render(context)
 
 
 @register.tag(name="usekwacro")
@@ -190,11 +207,10 @@ def do_usemacro(parser, token):
     for val in values:
         if "=" in val:
             # kwarg
-            name, value = val.split("=")
+            name, value = val.split("=", 1)
             fe_kwargs[name] = FilterExpression(value, parser)
         else:  # arg
             # no validation, go for it ...
             fe_args.append(FilterExpression(val, parser))
 
-    macro.parser = parser
     return UseMacroNode(macro, fe_args, fe_kwargs)
@@ -17,4 +17,845 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from django.test import TestCase
+"""
+Benchmarks of the hot views, followed by tests of behaviour they rely on
+(‘BehaviourTest’).
+
+Every benchmark seeds deterministic data set of certain size (using bulk
+mode of ‘populate.py’), requests a view through test client and measures
+wall time, number of SQL queries, and time spent rendering templates.
+Results are compared against baselines stored in ‘benchmarks.json’: number
+of queries must not grow at all, times must not grow more than
+‘GLASS_BENCH_TIME_FACTOR’ times (3 by default, machines differ).
+
+Environment variables:
+
+* ‘GLASS_BENCH_SIZES’ — comma-separated sizes of data sets to run
+  benchmarks on (see ‘SIZES’), by default only “small” is used;
+
+* ‘GLASS_BENCH_RECORD’ — if set, measured values are written to
+  ‘benchmarks.json’ as new baselines instead of being checked.
+"""
+
+import collections
+import gzip
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import unittest.mock
+
+from django.contrib.auth.models import User
+from django.core.cache          import caches
+from django.core.management     import call_command
+from django.core.urlresolvers   import reverse
+from django.db                  import connection, transaction
+from django.db.models           import Count
+from django.http                import HttpResponse
+from django.template.base       import Context, Template
+from django.test                import RequestFactory, TestCase
+from django.test                import TransactionTestCase
+from django.test                import override_settings
+from django.test.utils          import CaptureQueriesContext
+
+from glass.admin import delete_topic, estimated_count
+from glass.admission import IN_FLIGHT_KEY, change_in_flight
+from glass.archive import snapshot_path
+from glass import assets
+from glass.assets import AssetMiddleware
+from glass.likes import liked_ids, liked_key, toggle_like
+from glass.management.commands.archive_topics import archive_topic
+from glass.metrics import registry
+from glass.models import Tag, Topic, Message, TagRating, UserStats
+from glass.notify import Notifier, notifier
+from glass.pagecache import forget_pages, generation, page_key
+from glass.pagecache import run_committed, topic_generation
+from glass import routers
+from glass.routers import STICKY_COOKIE, ReplicaMiddleware, ReplicaRouter
+from glass import search
+from glass.search import get_backend
+from glass.templatetags import kwacros
+from glass import views
+
+import populate
+
+SIZES = {'small':  {'users': 50,   'tags': 5,  'topics': 50,   'messages': 1000},
+         'medium': {'users': 500,  'tags': 10, 'topics': 500,  'messages': 10000},
+         'large':  {'users': 5000, 'tags': 20, 'topics': 5000, 'messages': 100000}}
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'benchmarks.json')
+
+REPEAT = 5 # how many times every view is requested
+
+def enabled_sizes():
+    return os.environ.get('GLASS_BENCH_SIZES', 'small').split(',')
+
+def load_baselines():
+    try:
+        with open(BASELINES) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_baselines(baselines):
+    with open(BASELINES, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+class RenderTimer():
+    """
+    Context manager that measures total time spent rendering templates.
+    Nested templates are counted only once.
+    """
+
+    def __enter__(self):
+        self.total = 0.0
+        self.depth = 0
+        original = Template._render
+        timer = self
+
+        def timed_render(template, context):
+            timer.depth += 1
+            start = time.perf_counter()
+            try:
+                return original(template, context)
+            finally:
+                timer.depth -= 1
+                if timer.depth == 0:
+                    timer.total += time.perf_counter() - start
+
+        self.patch = unittest.mock.patch.object(Template, '_render',
+                                                timed_render)
+        self.patch.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.patch.stop()
+
+class ViewBenchmark(TestCase):
+    """
+    Base class of benchmarks, subclasses set ‘size’ to one of ‘SIZES’.
+    """
+
+    size = None
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+        if cls.size not in enabled_sizes():
+            raise unittest.SkipTest('data set size not enabled')
+        get_backend().cursor() # create search index outside of transaction
+        super(ViewBenchmark, cls).setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        size = SIZES[cls.size]
+        random.seed(42)
+        populate.bulk_users(size['users'], fast_hash=True)
+        populate.bulk_tags(size['tags'])
+        populate.bulk_topics(size['topics'])
+        populate.bulk_messages(size['messages'], seed=42)
+        with open(os.devnull, 'w') as devnull:
+            populate.bulk_finish(stdout=devnull)
+        cls.staff = User.objects.order_by('id').first()
+        cls.staff.is_staff = True
+        cls.staff.save()
+        cls.author = User.objects.annotate(n=Count('message'))\
+                                 .order_by('-n', 'id')[0]
+        cls.topic = Topic.objects.annotate(n=Count('message'))\
+                                 .order_by('-n', 'id')[0]
+        cls.tag = Tag.objects.order_by('name')[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ViewBenchmark, cls).tearDownClass()
+        if os.environ.get('GLASS_BENCH_RECORD'):
+            baselines = load_baselines()
+            baselines.update(cls.results)
+            save_baselines(baselines)
+
+    def setUp(self):
+        self.client.login(username=self.staff.username, password='user')
+
+    def measure(self, name, request):
+        """
+        Call ‘request’ (function that performs request with test client and
+        returns response) ‘REPEAT’ times and check median results against
+        baseline.
+        """
+        times, renders, queries = [], [], []
+        for i in range(REPEAT):
+            with CaptureQueriesContext(connection) as captured, \
+                 RenderTimer() as render:
+                start = time.perf_counter()
+                response = request(i)
+                times.append(time.perf_counter() - start)
+            self.assertIn(response.status_code, (200, 302, 304))
+            renders.append(render.total)
+            queries.append(len(captured.captured_queries))
+        result = {'time':    statistics.median(times),
+                  'render':  statistics.median(renders),
+                  'queries': max(queries)}
+        key = '{}/{}'.format(self.size, name)
+        print('\n{:24} {:8.4f}s {:8.4f}s {:6} queries'
+              .format(key, result['time'], result['render'], result['queries']),
+              end=' ')
+        self.results[key] = result
+        if os.environ.get('GLASS_BENCH_RECORD'):
+            return
+        baseline = load_baselines().get(key)
+        if baseline is None:
+            self.skipTest('no baseline for ' + key)
+        factor = float(os.environ.get('GLASS_BENCH_TIME_FACTOR', 3))
+        self.assertLessEqual(result['queries'], baseline['queries'],
+                             'number of queries regressed')
+        for measure in ('time', 'render'):
+            self.assertLessEqual(result[measure],
+                                 baseline[measure] * factor + 0.01,
+                                 '{} regressed'.format(measure))
+
+    def test_index(self):
+        url = reverse('index')
+        self.measure('index', lambda i: self.client.get(url, {'page': i + 1}))
+
+    def test_index_hot(self):
+        url = reverse('index')
+        self.measure('index-hot',
+                     lambda i: self.client.get(url, {'sort': 'hot',
+                                                     'page': i + 1}))
+
+    def test_index_anonymous(self):
+        url = reverse('index')
+        with override_settings(GLASS_PAGE_CACHE='default'):
+            caches['default'].clear()
+            self.client.logout()
+            self.client.get(url) # the page is cached now
+            self.measure('index-anonymous', lambda i: self.client.get(url))
+
+    def test_index_tag(self):
+        url = reverse('index')
+        self.measure('index-tag',
+                     lambda i: self.client.get(url, {'tag': self.tag.name}))
+
+    def test_index_search(self):
+        url = reverse('index')
+        self.measure('index-search',
+                     lambda i: self.client.get(url, {'search': 'South'}))
+
+    def test_topic(self):
+        url = reverse('topic', args=[self.topic.slug])
+        self.measure('topic', lambda i: self.client.get(url))
+
+    def test_topic_all(self):
+        url = reverse('topic', args=[self.topic.slug])
+        def request(i):
+            response = self.client.get(url, {'all': 1})
+            for chunk in response.streaming_content: # render everything
+                pass
+            return response
+        self.measure('topic-all', request)
+
+    def test_topic_not_modified(self):
+        url = reverse('topic', args=[self.topic.slug])
+        etag = self.client.get(url)['ETag']
+        def request(i):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            return response
+        self.measure('topic-304', request)
+
+    def test_topic_archived(self):
+        url = reverse('topic', args=[self.topic.slug])
+        with tempfile.TemporaryDirectory() as root, \
+             override_settings(GLASS_ARCHIVE_ROOT=root):
+            archive_topic(self.topic.id)
+            self.client.logout()
+            def request(i):
+                response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                return response
+            self.measure('topic-archived', request)
+            key = '{}/topic-archived'.format(self.size)
+            self.assertEqual(self.results[key]['queries'], 0)
+            Message.objects.create(author=self.staff, topic=self.topic,
+                                   content='Anybody here?')
+            self.assertFalse(os.path.exists(snapshot_path(self.topic.slug)))
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertContains(response, 'Anybody here?')
+
+    def test_user(self):
+        url = reverse('user', args=[self.author.username])
+        self.measure('user', lambda i: self.client.get(url))
+
+    def test_msg_like(self):
+        url = reverse('msg-like')
+        msg_id = self.topic.first_message_id
+        self.measure('msg-like',
+                     lambda i: self.client.post(url, {'msg_id': msg_id}))
+
+    def test_msg_del(self):
+        url = reverse('msg-del')
+        last = list(Message.objects.filter(topic=self.topic)
+                                   .order_by('-id')
+                                   .values_list('id', flat=True)[:REPEAT])
+        self.measure('msg-del',
+                     lambda i: self.client.get(url, {'msg_id': last[i]}))
+
+class SmallBenchmark(ViewBenchmark):
+    size = 'small'
+
+class MediumBenchmark(ViewBenchmark):
+    size = 'medium'
+
+class LargeBenchmark(ViewBenchmark):
+    size = 'large'
+
+@override_settings(GLASS_TOPIC_PAGE_SIZE=3)
+class BehaviourTest(TestCase):
+    """
+    Checks of behaviour that the optimizations benchmarked above must keep.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        get_backend().cursor() # create search index outside of transaction
+        super(BehaviourTest, cls).setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='user')
+        cls.reader = User.objects.create_user('reader', password='user')
+        cls.tag = Tag.objects.create(name='mars')
+        cls.topic = Topic(title='Life on Mars')
+        cls.topic.save()
+        cls.topic.tags.add(cls.tag)
+        cls.messages = [Message.objects.create(author=cls.author,
+                                               topic=cls.topic,
+                                               content='Message {}'.format(i))
+                        for i in range(7)]
+        cls.other = Topic(title='Evil flute')
+        cls.other.save()
+        Message.objects.create(author=cls.reader, topic=cls.other,
+                               content='Nothing about planets')
+
+    def setUp(self):
+        self.client.login(username='reader', password='user')
+
+    def etags(self):
+        return (self.client.get(reverse('index'))['ETag'],
+                self.client.get(reverse('topic',
+                                        args=[self.topic.slug]))['ETag'])
+
+    def test_etag_changes_after_like(self):
+        before = self.etags()
+        self.client.post(reverse('msg-like'),
+                         {'msg_id': self.messages[0].id})
+        after = self.etags()
+        self.assertNotEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+
+    def test_etag_after_like_of_reply(self):
+        before = self.etags()
+        self.client.post(reverse('msg-like'),
+                         {'msg_id': self.messages[1].id})
+        after = self.etags()
+        self.assertEqual(before[0], after[0]) # index shows initial messages
+        self.assertNotEqual(before[1], after[1])
+
+    def test_etag_changes_after_message(self):
+        before = self.etags()
+        Message.objects.create(author=self.reader, topic=self.topic,
+                               content='Is there anybody?')
+        after = self.etags()
+        self.assertNotEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+
+    def assertLikes(self, count):
+        first = self.messages[0]
+        self.assertEqual(Message.objects.get(id=first.id).like_count, count)
+        self.assertEqual(first.likers.count(), count)
+        self.assertEqual(Topic.objects.get(id=self.topic.id).rating, count)
+        self.assertEqual(TagRating.objects.get(topic=self.topic).rating, count)
+        self.assertEqual(UserStats.objects.get(user=self.author).likes, count)
+
+    def test_toggle_like(self):
+        first = self.messages[0]
+        self.assertEqual(toggle_like(first, self.reader), (True, 1))
+        self.assertLikes(1)
+        self.assertEqual(toggle_like(first, self.reader), (False, 0))
+        self.assertLikes(0)
+
+    def test_like_of_reply(self):
+        reply = Message.objects.get(id=self.messages[1].id)
+        with self.assertNumQueries(10): # 7 in transaction, read, topic, stats
+            self.assertEqual(reply.toggle_like(self.reader), (True, 1))
+        self.assertEqual(Message.objects.get(id=reply.id).version,
+                         reply.version) # its fragment is still good
+        self.assertEqual(Topic.objects.get(id=self.topic.id).rating, 0)
+        self.assertEqual(TagRating.objects.get(topic=self.topic).rating, 0)
+        self.assertEqual(UserStats.objects.get(user=self.author).likes, 1)
+
+    def test_reconcile_likes(self):
+        reply = self.messages[1]
+        Message.objects.filter(id=reply.id).update(like_count=5)
+        call_command('reconcile_likes', stdout=io.StringIO())
+        fixed = Message.objects.get(id=reply.id)
+        self.assertEqual(fixed.like_count, 0)
+        self.assertEqual(fixed.version, reply.version)
+        self.assertGreater(Topic.objects.get(id=self.topic.id).version,
+                           self.topic.version)
+
+    def test_delete_initial_message(self):
+        toggle_like(self.messages[1], self.reader)
+        # like admin does, not through the view:
+        Message.objects.get(id=self.messages[0].id).delete()
+        topic = Topic.objects.get(id=self.topic.id)
+        self.assertEqual(topic.first_message_id, self.messages[1].id)
+        self.assertEqual(topic.rating, 1)
+        self.assertEqual(TagRating.objects.get(topic=topic).rating, 1)
+
+    def test_index_pages(self):
+        def page(number):
+            response = self.client.get(reverse('index'),
+                                       {'page': number, 'page_size': 1,
+                                        'sort': 'new'})
+            page = response.context['page']
+            return [topic.id for topic in page], page.has_next()
+        self.assertEqual(page(1), ([self.other.id], True))
+        self.assertEqual(page(2), ([self.topic.id], False))
+        self.assertEqual(page(3), page(1))
+        self.assertEqual(page('x'), page(1))
+
+    def stats(self, user):
+        stats = UserStats.objects.get(user=user)
+        return stats.messages, stats.likes, stats.topics
+
+    def test_user_stats(self):
+        self.assertEqual(self.stats(self.author), (7, 0, 1))
+        self.assertEqual(self.stats(self.reader), (1, 0, 1))
+        toggle_like(self.messages[2], self.reader)
+        Message.objects.create(author=self.reader, topic=self.topic,
+                               content='Second message')
+        self.assertEqual(self.stats(self.author), (7, 1, 1))
+        self.assertEqual(self.stats(self.reader), (2, 0, 1))
+        # the next message of the same author becomes initial message:
+        Message.objects.get(id=self.messages[0].id).delete()
+        self.assertEqual(self.stats(self.author), (6, 1, 1))
+
+    def test_rebuild_user_stats(self):
+        toggle_like(self.messages[2], self.reader)
+        expected = [self.stats(user) for user in (self.author, self.reader)]
+        UserStats.objects.update(messages=0, likes=5, topics=3)
+        call_command('rebuild_user_stats', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual([self.stats(user)
+                          for user in (self.author, self.reader)], expected)
+
+    def new_topic(self, title, size):
+        topic = Topic.objects.create(title=title)
+        for i in range(size):
+            Message.objects.create(author=self.author, topic=topic,
+                                   content='{} {}'.format(title, i))
+        return topic
+
+    def test_delete_topic(self):
+        toggle_like(self.messages[3], self.reader)
+        delete_topic(Topic.objects.get(id=self.topic.id), chunk_size=2)
+        self.assertFalse(Topic.objects.filter(id=self.topic.id).exists())
+        self.assertFalse(Message.objects.filter(topic=self.topic.id).exists())
+        self.assertFalse(Message.likers.through.objects.exists())
+        self.assertEqual(self.stats(self.author), (0, 0, 0))
+        self.assertEqual(self.stats(self.reader), (1, 0, 1))
+        self.assertEqual(self.client.get(reverse('index'),
+                                         {'search': 'Message'})
+                             .context['page'], None)
+        # every chunk takes the same number of queries, whatever its size
+        def queries(size):
+            topic = self.new_topic('Size {}'.format(size), size)
+            with CaptureQueriesContext(connection) as captured:
+                delete_topic(topic, chunk_size=10)
+            return len(captured)
+        self.assertEqual(queries(2), queries(6))
+
+    def test_estimated_count(self):
+        last = Topic.objects.latest('id').id
+        self.assertEqual(estimated_count(Topic.objects.all()), last)
+        self.assertEqual(estimated_count(
+            Topic.objects.filter(title='Evil flute')), 1)
+
+    def test_delete_objects(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        url = reverse('admin:glass_topic_changelist')
+        data = {'action': 'delete_objects',
+                '_selected_action': [self.other.id]}
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['model_count'],
+                         [('topics', 1), ('messages', 1)])
+        self.assertTrue(Topic.objects.filter(id=self.other.id).exists())
+        data['post'] = 'yes'
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertFalse(Topic.objects.filter(id=self.other.id).exists())
+        self.assertEqual(self.stats(self.reader), (0, 0, 0))
+
+    def page(self, **params):
+        response = self.client.get(reverse('topic', args=[self.topic.slug]),
+                                   params)
+        self.assertEqual(response.status_code, 200)
+        return [message.id
+                for message in response.context['topic_context'].messages]
+
+    def test_keyset_paging(self):
+        ids = [message.id for message in self.messages]
+        self.assertEqual(self.page(), ids[:3])
+        self.assertEqual(self.page(after=ids[2]), ids[3:6])
+        self.assertEqual(self.page(after=ids[5]), ids[6:])
+        self.assertEqual(self.page(before=ids[6]), ids[3:6])
+        self.assertEqual(self.page(before=ids[1]), ids[:1])
+        self.assertEqual(self.page(msg=ids[4]), ids[4:7])
+
+    def test_search(self):
+        def found(query):
+            response = self.client.get(reverse('index'), {'search': query})
+            page = response.context['page']
+            return [topic.id for topic in page.object_list] if page else []
+        self.assertEqual(found('Mars'), [self.topic.id])
+        self.assertEqual(found('planets'), [self.other.id])
+        self.assertEqual(found('Jupiter'), [])
+
+    def test_router_stickiness(self):
+        factory = RequestFactory()
+        middleware = ReplicaMiddleware()
+        router = ReplicaRouter()
+        with override_settings(GLASS_REPLICAS=('replica',)):
+            request = factory.get('/')
+            middleware.process_request(request)
+            self.assertEqual(router.db_for_read(Message), 'replica')
+            UserStats(user=self.reader) # assigned, but not written
+            self.assertEqual(router.db_for_read(Message), 'replica')
+            response = middleware.process_response(request, HttpResponse())
+            self.assertNotIn(STICKY_COOKIE, response.cookies)
+            request = factory.post('/')
+            middleware.process_request(request)
+            middleware.process_view(request, lambda request: None, (), {})
+            self.assertEqual(router.db_for_read(Message), 'default')
+            response = middleware.process_response(request, HttpResponse())
+            self.assertIn(STICKY_COOKIE, response.cookies)
+            # GET of page that writes only on POST is a read:
+            request = factory.get('/')
+            middleware.process_request(request)
+            middleware.process_view(request, views.topic, (), {})
+            self.assertEqual(router.db_for_read(Message), 'replica')
+            middleware.process_response(request, HttpResponse())
+            request = factory.get('/')
+            request.COOKIES[STICKY_COOKIE] = '1'
+            middleware.process_request(request)
+            self.assertEqual(router.db_for_read(Message), 'default')
+            middleware.process_response(request, HttpResponse())
+
+    def like(self, **extra):
+        return self.client.post(reverse('msg-like'),
+                                {'msg_id': self.messages[0].id}, **extra)
+
+    @override_settings(GLASS_WRITE_BURST=2, GLASS_WRITE_RATE=1)
+    def test_write_rate(self):
+        caches['default'].clear()
+        self.assertEqual(self.like().status_code, 200)
+        self.assertEqual(self.like().status_code, 200)
+        response = self.like()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        # reads and writes that are not marked are never throttled:
+        self.assertEqual(self.client.get(reverse('index')).status_code, 200)
+        response = self.client.post(reverse('user', args=['reader']),
+                                    {'email': 'reader@example.com'})
+        self.assertEqual(response.status_code, 200)
+        later = time.time() + 1.5
+        with unittest.mock.patch('glass.admission.time.time',
+                                 return_value=later):
+            self.assertEqual(self.like().status_code, 200)
+            self.assertEqual(self.like().status_code, 429)
+
+    @override_settings(GLASS_MAX_WRITES_IN_FLIGHT=1)
+    def test_writes_in_flight(self):
+        cache = caches['default']
+        cache.clear()
+        change_in_flight(cache, 1) # somebody else is writing
+        response = self.like(HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(json.loads(response.content.decode())['retry_after'],
+                         1)
+        change_in_flight(cache, -1)
+        self.assertEqual(self.like().status_code, 200)
+        self.assertEqual(cache.get(IN_FLIGHT_KEY), 0)
+
+    def since(self, since, **params):
+        response = self.client.get(reverse('topic-since',
+                                           args=[self.topic.slug]),
+                                   dict(params, since=since))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_topic_since(self):
+        ids = [message.id for message in self.messages]
+        answer = self.since(ids[4])
+        self.assertEqual(answer['last_id'], ids[6])
+        self.assertEqual(answer['retry'], 10)
+        self.assertIn('id="{}"'.format(ids[5]), answer['html'])
+        self.assertIn('id="{}"'.format(ids[6]), answer['html'])
+        self.assertNotIn('id="{}"'.format(ids[4]), answer['html'])
+        self.assertEqual(self.since(ids[6]),
+                         {'html': '', 'last_id': ids[6], 'retry': 10})
+        with override_settings(GLASS_LONG_POLL=True):
+            self.assertEqual(self.since(ids[6])['retry'], 0)
+
+    def test_topic_since_replica(self):
+        """
+        Plain polls read from replica, waiting ones from the primary.
+        """
+        self.client.logout() # no sticky cookie
+        seen = set()
+        def db_for_read(router, model, **hints):
+            if model is Message:
+                seen.add(getattr(routers.state, 'replica', None))
+            return 'default' # there is no replica in tests
+        last_id = self.messages[-1].id
+        with override_settings(GLASS_REPLICAS=('replica',)), \
+             unittest.mock.patch.object(ReplicaRouter, 'db_for_read',
+                                        db_for_read), \
+             unittest.mock.patch.object(notifier, 'wait',
+                                        return_value=False):
+            self.since(last_id)
+            self.assertEqual(seen, {'replica'})
+            seen.clear()
+            with override_settings(GLASS_LONG_POLL=True):
+                self.since(last_id, wait=1)
+            self.assertEqual(seen, {None})
+
+    def test_notifier(self):
+        notifier = Notifier()
+        with unittest.mock.patch.object(notifier, 'poll'):
+            self.assertFalse(notifier.wait(1, 0, 0.01))
+            threading.Timer(0.05, notifier.notify, (1, 5)).start()
+            self.assertTrue(notifier.wait(1, 0, 5))
+            self.assertEqual(notifier.latest_in(1), 5)
+            self.assertFalse(notifier.wait(1, 5, 0.01))
+            notifier.notify(1, 3) # late announcement of older message
+            self.assertEqual(notifier.latest_in(1), 5)
+        with notifier.condition:
+            notifier.prune(time.monotonic() + 1)
+        self.assertEqual(notifier.latest_in(1), 0)
+
+    def test_new_message_announced(self):
+        message = Message.objects.create(author=self.reader, topic=self.topic,
+                                         content='Anybody there?')
+        self.assertEqual(notifier.latest_in(self.topic.id), message.id)
+
+    @override_settings(GLASS_LIKES_CACHE='default', GLASS_LIKED_CACHE_MIN=1)
+    def test_liked_cache(self):
+        cache = caches['default']
+        cache.clear()
+        ids = [message.id for message in self.messages]
+        toggle_like(self.messages[0], self.reader)
+        self.assertEqual(liked_ids(self.reader, ids), {ids[0]})
+        self.assertIsNotNone(cache.get(liked_key(self.reader.id)))
+        toggle_like(self.messages[1], self.reader)
+        self.assertIsNone(cache.get(liked_key(self.reader.id)))
+        with self.assertNumQueries(2): # rebuilt once, then cached
+            self.assertEqual(liked_ids(self.reader, ids), {ids[0], ids[1]})
+            self.assertEqual(liked_ids(self.reader, ids), {ids[0], ids[1]})
+        toggle_like(self.messages[0], self.reader)
+        self.assertEqual(liked_ids(self.reader, ids), {ids[1]})
+
+    def test_search_backend_fallback(self):
+        backend = get_backend()
+        self.assertTrue(search.SQLiteBackend.supported(connection))
+        try:
+            search._backend = None
+            with unittest.mock.patch.object(search.SQLiteBackend, 'supported',
+                                            return_value=False):
+                self.assertIsInstance(get_backend(), search.SimpleBackend)
+        finally:
+            search._backend = backend
+
+    def test_search_table_ready_after_commit(self):
+        backend = search.SQLiteBackend()
+        backend.cursor() # inside of transaction of the test
+        self.assertIsNone(backend.ready_in)
+
+    def test_fragments_after_renames(self):
+        self.client.get(reverse('topic', args=[self.topic.slug])) # cached
+        topic = Topic.objects.get(id=self.topic.id)
+        topic.title = 'Life on Venus'
+        topic.save()
+        User.objects.filter(id=self.author.id).update(username='writer')
+        response = self.client.get(reverse('topic', args=[topic.slug]))
+        self.assertContains(response, '/topic/life-on-venus/?msg=')
+        self.assertContains(response, 'href="/user/writer/"')
+        self.assertNotContains(response, 'life-on-mars')
+        self.assertNotContains(response, '/user/author/')
+
+    def recorded(self, metric, view):
+        return registry.values.get((metric, view), 0)
+
+    def test_metrics_count_queries(self):
+        url = reverse('topic', args=[self.topic.slug])
+        before = self.recorded('glass_sql_queries_total', 'topic')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(self.recorded('glass_sql_queries_total', 'topic'),
+                         before + len(queries))
+        log = collections.deque(maxlen=1) # the log is not needed
+        with unittest.mock.patch.object(connection, 'queries_log', log):
+            self.client.get(url)
+        self.assertFalse(log)
+        self.assertEqual(self.recorded('glass_sql_queries_total', 'topic'),
+                         before + 2 * len(queries))
+
+    def test_metrics_of_streamed_response(self):
+        url = reverse('topic', args=[self.topic.slug])
+        before = self.recorded('glass_sql_queries_total', 'topic')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'all': 1})
+            head = len(queries) # the page without messages
+            for chunk in response.streaming_content:
+                pass
+        self.assertGreater(len(queries), head)
+        self.assertEqual(self.recorded('glass_sql_queries_total', 'topic'),
+                         before + len(queries))
+
+    def test_metrics_allowed_ips(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.settings(GLASS_METRICS_ALLOWED_IPS=['127.0.0.1']):
+            response = self.client.get(url)
+        self.assertContains(response, 'glass_sql_queries_total{view="topic"}')
+
+    def test_kwacros(self):
+        template = Template(
+            '{% load kwacros %}'
+            '{% kwacro greet who greeting="Hello"|upper %}'
+            '{{ greeting }}, {{ who }}{% endkwacro %}'
+            '{% usekwacro greet name %}; '
+            '{% usekwacro greet "Venus" greeting=word %}; '
+            '{% usekwacro greet %}; {{ who }}{{ greeting }}')
+        with unittest.mock.patch.object(kwacros, 'FilterExpression') as fe:
+            content = template.render(Context({'name': 'Mars',
+                                               'word': 'Bye'}))
+        self.assertFalse(fe.called) # compiled once, by the parser
+        self.assertEqual(content, 'HELLO, Mars; Bye, Venus; HELLO, ; ')
+
+    def test_kwacros_loaded_once(self):
+        kwacros._loaded_macros.pop('glass/base.html', None)
+        source = '{% load kwacros %}{% loadkwacros "glass/base.html" %}' \
+                 '{% usekwacro title %}'
+        with unittest.mock.patch.object(kwacros, 'get_template',
+                                        wraps=kwacros.get_template) as get:
+            for i in range(3):
+                content = Template(source).render(Context())
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(content.strip(), 'Missing title')
+
+    def test_assets(self):
+        fake_brotli = unittest.mock.Mock(compress=lambda data: b'br')
+        with tempfile.TemporaryDirectory() as root, \
+             self.settings(STATIC_ROOT=root), \
+             unittest.mock.patch.object(assets, 'brotli', fake_brotli):
+            call_command('collectstatic', interactive=False, verbosity=0)
+            url = Template('{% load staticfiles %}{% static "css/glass.css" %}')\
+                .render(Context())
+            self.assertRegex(url, r'^/static/css/glass\.[0-9a-f]{12}\.css$')
+            path = os.path.join(root, url[len('/static/'):])
+            self.assertTrue(os.path.isfile(path + '.gz'))
+            with open(path, 'rb') as f:
+                original = f.read()
+            def get(url, accept):
+                response = AssetMiddleware().process_request(
+                    RequestFactory().get(url, HTTP_ACCEPT_ENCODING=accept))
+                content = b''.join(response.streaming_content)
+                response.close()
+                return response, content
+            response, content = get(url, 'gzip, br')
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(content, b'br')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            response, content = get(url, 'gzip, br;q=0')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(content), original)
+            response, content = get(url, 'identity')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(content, original)
+            response, content = get('/static/css/glass.css', 'gzip')
+            self.assertIn('must-revalidate', response['Cache-Control'])
+            self.assertEqual(gzip.decompress(content), original)
+
+@override_settings(GLASS_PAGE_CACHE='default')
+class PageCacheTest(TransactionTestCase):
+    """
+    Page cache for anonymous users, outside of test transaction, since its
+    pages are forgotten only after changes are committed.
+    """
+
+    def setUp(self):
+        self.cache = caches['default']
+        self.cache.clear()
+        self.author = User.objects.create_user('author', password='user')
+        self.topic = Topic.objects.create(title='Life on Mars')
+        self.message = Message.objects.create(author=self.author,
+                                              topic=self.topic,
+                                              content='Is there life?')
+        self.url = reverse('topic', args=[self.topic.slug])
+
+    def token(self):
+        return generation(self.cache, topic_generation(None, self.topic.slug))
+
+    def lock(self):
+        request = RequestFactory().get(self.url)
+        return page_key(request, ('after', 'before', 'msg', 'all')) + ':lock'
+
+    def test_forgotten_after_commit(self):
+        token = self.token()
+        with transaction.atomic():
+            forget_pages([self.topic.slug])
+            self.assertEqual(self.token(), token)
+        run_committed()
+        self.assertNotEqual(self.token(), token)
+
+    def test_invalidation(self):
+        content = self.client.get(self.url).content
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).content, content)
+        writer = self.client_class()
+        writer.login(username='author', password='user')
+        writer.post(self.url, {'content': 'Yes, there is.'})
+        self.assertIn(b'Yes, there is.', self.client.get(self.url).content)
+        # likes are written in transaction, pages are forgotten after it
+        token = self.token()
+        writer.post(reverse('msg-like'), {'msg_id': self.message.id})
+        self.assertNotEqual(self.token(), token)
+
+    def test_stale_page(self):
+        content = self.client.get(self.url).content
+        Message.objects.create(author=self.author, topic=self.topic,
+                               content='Yes, there is.')
+        self.cache.add(self.lock(), True) # somebody is rendering it
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).content, content)
+        self.cache.delete(self.lock())
+        self.assertIn(b'Yes, there is.', self.client.get(self.url).content)
+
+    def test_single_flight(self):
+        self.cache.add(self.lock(), True)
+        threading.Timer(0.2, self.cache.delete, (self.lock(),)).start()
+        start = time.perf_counter()
+        response = self.client.get(self.url) # no copy, waits for the lock
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        self.assertEqual(response.status_code, 200)
@@ -18,14 +18,16 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf.urls import patterns, url
-from glass import views
+from glass import metrics, views
 
 urlpatterns = [
-    url('^$',                            views.index,     name='index'),
-    url('^about/$',                      views.about,     name='about'),
-    url('^topic/(?P<slug>[\w\-]+)/$',    views.topic,     name='topic'),
-    url('^new-topic/$',                  views.new_topic, name='new-topic'),
-    url('^user/(?P<username>[\w\-]+)/$', views.user,      name='user'),
-    url('^msg-like/$',                   views.msg_like,  name='msg-like'),
-    url('^msg-del/$',                    views.msg_del,   name='msg-del'),
+    url('^$',                               views.index,       name='index'),
+    url('^about/$',                         views.about,       name='about'),
+    url('^topic/(?P<slug>[\w\-]+)/$',       views.topic,       name='topic'),
+    url('^topic/(?P<slug>[\w\-]+)/since/$', views.topic_since, name='topic-since'),
+    url('^new-topic/$',                     views.new_topic,   name='new-topic'),
+    url('^user/(?P<username>[\w\-]+)/$',    views.user,        name='user'),
+    url('^msg-like/$',                      views.msg_like,    name='msg-like'),
+    url('^msg-del/$',                       views.msg_del,     name='msg-del'),
+    url('^metrics/$',                       metrics.metrics,   name='metrics'),
 ]
@@ -17,83 +17,183 @@
 # You should have received a copy of the GNU General Public License along
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
+from django.conf                    import settings
 from django.contrib.auth.decorators import login_required
-from django.core.paginator          import Paginator, EmptyPage, PageNotAnInteger
-from django.http                    import HttpResponse
+from django.core.paginator          import Paginator, Page, InvalidPage
+from django.core.urlresolvers       import reverse
+from django.db                      import DEFAULT_DB_ALIAS, router
+from django.http                    import HttpResponse, JsonResponse
+from django.http                    import StreamingHttpResponse
 from django.shortcuts               import render, redirect, get_object_or_404
+from django.template.loader         import render_to_string
 from django.views.decorators.http   import require_GET, require_POST
 
-from glass.forms  import UserForm, TopicForm, MessageForm
-from glass.models import User, Tag, Topic, Message
+from glass.admission   import writes, writes_on
+from glass.archive     import serve_archived
+from glass.conditional import conditional_page, get_topic
+from glass.conditional import topic_etag, topic_last_modified
+from glass.conditional import index_etag, index_last_modified
+from glass.context     import TopicRenderContext, topic_page
+from glass.context     import MESSAGES_PLACEHOLDER, last_message_id
+from glass.context     import stream_messages
+from glass.forms       import UserForm, TopicForm, MessageForm
+from glass.likes       import LikedMessages, toggle_like
+from glass.models      import User, Tag, Topic, Message, UserStats
+from glass.notify      import notifier
+from glass.pagecache   import cache_anonymous
+from glass.pagecache   import index_generation, topic_generation
+from glass.routers     import reading_from, use_primary
+from glass.search      import get_backend as get_search_backend
+
+class UncountedPaginator(Paginator):
+    """
+    Paginator that doesn't count objects (which takes scanning all of them):
+    every page is fetched with one more object to find out whether there
+    is next page. Number of pages is unknown, so only pages up to the next
+    one can be linked.
+    """
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise InvalidPage("That page number is not an integer")
+        if number < 1:
+            raise InvalidPage("That page number is less than 1")
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        objects = list(self.object_list[bottom:bottom + self.per_page + 1])
+        return UncountedPage(objects[:self.per_page], number, self,
+                             len(objects) > self.per_page)
+
+class UncountedPage(Page):
+
+    def __init__(self, object_list, number, paginator, has_next):
+        super(UncountedPage, self).__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+def int_param(request, name):
+    """
+    Return value of GET parameter ‘name’ as integer or ‘None’ if it's
+    missing or malformed.
+    """
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+# Orderings of index page: values of ‘sort’ parameter → fields of ‘Topic’
+# (and ‘TagRating’, where ‘id’ is ‘topic’) to order by, descending.
+SORTS = {'top':    'rating',
+         'hot':    'hot',
+         'active': 'last_posted',
+         'new':    'id'}
+SORT_LABELS = [('top', "Top"), ('hot', "Hot"), ('active', "Active"),
+               ('new', "New")]
 
 @require_GET
+@cache_anonymous(('page', 'page_size', 'tag', 'search', 'sort'),
+                 index_generation)
+@conditional_page(index_etag, index_last_modified)
 def index(request):
     """
     Index page of the project.
 
     The page presents list of popular topics ordered by default by number of
-    “likes”. Pagination, search.
+    “likes”, ‘sort’ parameter selects other orderings (see ‘SORTS’).
+    Pagination, full-text search (see ‘glass.search’).
     """
     page_size = request.GET.get('page_size', 5)
     page      = request.GET.get('page', 1)
     tag       = request.GET.get('tag')
     search    = request.GET.get('search')
-    tm        = Topic.objects
-    topics    = tm.filter(tags__in=[tag]) if tag else tm.all()
-    if search:
-        topics = topics.filter(title__contains=search)
-    # FIXME The following processing logic assumes that relatively small
-    # (maybe a few hundreds) number of topics is returned by ‘topic’ query
-    # set. This may be *quite* slow if the data base contains lots of
-    # topics. If this is the case, we could add ‘initial_message’ foreign
-    # key field to ‘Topic’ model and use it to sort topics on data base
-    # level. Other solutions would involve lower level of interaction with
-    # the data base and thus may lock the application into using of
-    # particular back-end, which is often bad design.
-    topics = sorted(list(topics),
-                    key=lambda x: x.initial_message().likes(),
-                    reverse=True)
-    context = {}
-    if topics:
-        paginator = Paginator(topics, page_size)
-        num_pages = paginator.num_pages
-        try:
-            p = paginator.page(page)
-        except PageNotAnInteger:
-            contacts = paginator.page(1)
-        except EmptyPage:
-            p = paginator.page(num_pages)
+    sort      = request.GET.get('sort')
+    order     = SORTS.get(sort, 'rating')
+    # Topics are ordered by precomputed scores (‘rating’ is denormalized
+    # number of “likes” of initial message, etc.), so ordering and
+    # pagination happen on data base level using indexes.
+    topics    = Topic.objects.select_related('first_message')\
+                             .prefetch_related('tags')
+    if tag: # use scores of topics per tag, see ‘TagRating’
+        topics = topics.filter(tag_ratings__tag=tag)
+        if order == 'id':
+            topics = topics.order_by('-tag_ratings__topic')
+        else:
+            topics = topics.order_by('-tag_ratings__' + order,
+                                     '-tag_ratings__topic')
+    elif order == 'id':
+        topics = topics.order_by('-id')
+    else:
+        topics = topics.order_by('-' + order, '-id')
+    if search: # found topics are ordered by relevance unless sort is given
+        topics = get_search_backend().search(search,
+                                             tag,
+                                             order if sort in SORTS else None)
+    context = {'sorts': SORT_LABELS}
+    paginator = UncountedPaginator(topics, page_size)
+    try:
+        p = paginator.page(page)
+    except InvalidPage:
+        p = paginator.page(1)
+    if not p.object_list and p.number > 1: # beyond the last page
+        p = paginator.page(1)
+    if p.object_list:
         context['page'] = p
-        # Range of page links to show, we should take care of situations
-        # when there are too many pages:
-        page_range = range(max(1, p.number - 4),
-                           min(num_pages, p.number + 4) + 1)
-        context['page_range'] = page_range
-        context['num_pages'] = num_pages
+        context['likes'] = LikedMessages(request.user,
+                                         [t.first_message for t in p])
+        # Range of page links to show, number of pages is not known (see
+        # ‘UncountedPaginator’):
+        context['page_range'] = range(max(1, p.number - 4),
+                                      p.number + int(p.has_next()) + 1)
     else:
         context['page'] = None
     return render(request, 'glass/index.html', context=context)
 
+@cache_anonymous(())
 def about(request):
     """
     About page, nothing special.
     """
     return render(request, 'glass/about.html')
 
+@serve_archived
+@writes_on('POST')
+@cache_anonymous(('after', 'before', 'msg', 'all'), topic_generation)
+@conditional_page(topic_etag, topic_last_modified)
 def topic(request, slug):
     """
     Topic-dedicated page.
 
-    This displays all messages in order and allows registered users to post
-    new messages. This page features anchor links per message and ability to
-    edit or delete last posted message for its author. Messages can be
-    “liked” too and this is reversible.
+    This displays messages in order and allows registered users to post new
+    messages. Messages are paginated by their ids (see
+    ‘glass.context.topic_page’). This page features anchor links per message
+    and ability to edit or delete last posted message for its author.
+    Messages can be “liked” too and this is reversible.
+
+    With ‘all’ parameter all messages are shown on one page, which is
+    streamed (see ‘stream_topic’). Archived topics are served to anonymous
+    users from snapshots (see ‘glass.archive’).
     """
-    topic = get_object_or_404(Topic, slug=slug)
-    messages = Message.objects.filter(topic=topic)
+    topic = get_topic(request, slug)
+    if request.method == 'GET' and 'all' in request.GET:
+        return stream_topic(request, topic)
+    messages = topic_page(topic,
+                          after=int_param(request, 'after'),
+                          before=int_param(request, 'before'),
+                          anchor=int_param(request, 'msg'))
+    topic_context = TopicRenderContext(topic, request.user, messages)
     context = {'topic': topic,
                'form': MessageForm(),
-               'messages': messages}
+               'topic_context': topic_context,
+               'last_id': topic_context.last_id}
     if request.user.is_authenticated():
         if request.method == 'POST':
             msg_form = MessageForm(request.POST)
@@ -103,12 +203,90 @@ def topic(request, slug):
                 message.topic = topic
                 message.save()
                 msg_form.save_m2m()
-                return redirect('topic', slug=slug)
+                # go to the last page, which ends with the new message:
+                return redirect('{}?before={}#{}'.format(
+                    reverse('topic', args=[slug]),
+                    message.id + 1,
+                    message.id))
             else:
                 context['form'] = msg_form # render errors
     return render(request, 'glass/topic.html', context)
 
+def stream_topic(request, topic):
+    """
+    Topic page with all messages of topic. The page is rendered without
+    messages and sent right away, then messages are rendered and sent in
+    batches, so memory usage doesn't depend on size of topic.
+    """
+    last_id = last_message_id(topic)
+    page = render_to_string('glass/topic.html',
+                            {'topic':   topic,
+                             'form':    MessageForm(),
+                             'stream':  True,
+                             'last_id': last_id},
+                            request=request)
+    head, tail = page.split(MESSAGES_PLACEHOLDER, 1)
+    db = router.db_for_read(Message) # middleware forgets it before streaming
+    def content():
+        yield head
+        with reading_from(db):
+            yield from stream_messages(topic, request.user, last_id)
+        yield tail
+    return StreamingHttpResponse(content())
+
+@require_GET
+def topic_since(request, slug):
+    """
+    Messages of topic posted after message with id ‘since’.
+
+    Answer is JSON object with messages rendered like on topic page (‘html’),
+    id of the last returned message (‘last_id’) and number of seconds
+    the client should wait before asking again (‘retry’). With
+    ‘GLASS_LONG_POLL’, if ‘wait’ parameter is given and there are no new
+    messages, this waits for them up to ‘wait’ seconds (at most
+    ‘GLASS_LONG_POLL_TIMEOUT’), see ‘glass.notify’.
+
+    Plain polls read from replica like other pages (users who have just
+    posted read from the primary anyway, see ‘glass.routers’). Waiting
+    requests read from the primary: they are woken up by its messages,
+    which replicas may not have yet.
+    """
+    since = int_param(request, 'since') or 0
+    if getattr(settings, 'GLASS_LONG_POLL', False):
+        wait = min(int_param(request, 'wait') or 0,
+                   getattr(settings, 'GLASS_LONG_POLL_TIMEOUT', 30))
+        retry = 0
+    else:
+        wait = 0
+        retry = getattr(settings, 'GLASS_POLL_INTERVAL', 10)
+    if wait:
+        with reading_from(DEFAULT_DB_ALIAS):
+            return messages_since(request, slug, since, wait, retry)
+    return messages_since(request, slug, since, wait, retry)
+
+def messages_since(request, slug, since, wait, retry):
+    """
+    Answer of ‘topic_since’, waiting up to ‘wait’ seconds.
+    """
+    topic = get_object_or_404(Topic, slug=slug)
+    deadline = time.time() + wait
+    threshold = since
+    messages = topic_page(topic, after=since)
+    while not messages and time.time() < deadline:
+        if not notifier.wait(topic.id, threshold, deadline - time.time()):
+            break
+        # don't wake up again for a message that is not visible (yet):
+        threshold = notifier.latest_in(topic.id)
+        messages = topic_page(topic, after=since)
+    if not messages:
+        return JsonResponse({'html': '', 'last_id': since, 'retry': retry})
+    topic_context = TopicRenderContext(topic, request.user, messages)
+    return JsonResponse({'html': ''.join(map(topic_context.render, messages)),
+                         'last_id': messages[-1].id,
+                         'retry': retry})
+
 @login_required
+@writes_on('POST')
 def new_topic(request):
     """
     Creation of new topics.
@@ -141,12 +319,23 @@ def user(request, username):
     User profile.
 
     Every registered user can see all profiles, but only his own profile is
-    editable for him. This page also displays latest messages authored by
-    the user.
+    editable for him. This page also displays statistics of the user (see
+    ‘UserStats’) and latest messages authored by him. Number of queries
+    doesn't depend on activity of the user.
     """
-    user = get_object_or_404(User, username=username)
-    latest_msgs = Message.objects.filter(author=user).order_by('-id')[:5]
-    context = {'this_user': user, 'latest_msgs': latest_msgs}
+    user = get_object_or_404(User.objects.select_related('stats'),
+                             username=username)
+    try:
+        stats = user.stats
+    except UserStats.DoesNotExist: # the user hasn't posted anything yet
+        stats = UserStats(user=user)
+    latest_msgs = list(Message.objects.filter(author=user)
+                                      .select_related('topic')
+                                      .order_by('-id')[:5])
+    context = {'this_user': user,
+               'stats': stats,
+               'latest_msgs': latest_msgs,
+               'likes': LikedMessages(request.user, latest_msgs)}
     if request.user == user:
         if request.method == 'GET':
             context['form'] = UserForm(instance=user)
@@ -166,7 +355,8 @@ def carefully_get_msg(request):
     user = request.user
     if not user.is_authenticated():
         return None
-    msg_id = request.GET.get('msg_id')
+    params = request.POST if request.method == 'POST' else request.GET
+    msg_id = params.get('msg_id')
     if not msg_id:
         return None
     try:
@@ -175,24 +365,24 @@ def carefully_get_msg(request):
         return None
     return msg
 
-@require_GET
+@require_POST
+@writes
 def msg_like(request):
     """
     This is how users can like messages.
 
-    Invoked by Java Script from topic page.
+    Invoked by Java Script from topic page. Answer is JSON object with
+    number of ‘likes’ and whether the user ‘liked’ the message.
     """
     msg = carefully_get_msg(request)
     if not msg:
-        return HttpResponse('0')
-    if msg.likers.filter(username=request.user.username).exists():
-        msg.likers.remove(request.user)
-    else:
-        msg.likers.add(request.user)
-    msg.save()
-    return HttpResponse(str(msg.likes()))
+        return JsonResponse({'error': 'no such message'}, status=400)
+    liked, likes = toggle_like(msg, request.user)
+    return JsonResponse({'likes': likes, 'liked': liked})
 
 @require_GET
+@use_primary
+@writes
 def msg_del(request):
     """
     Deletion of message.
@@ -201,10 +391,10 @@ def msg_del(request):
     deleted and only by its author. Staff can delete everything, of course.
     """
     msg = carefully_get_msg(request)
-    topic = msg.topic
     if not msg or not msg.editable_by(request.user):
         return HttpResponse('')
-    msg.delete()
+    topic = msg.topic
+    msg.delete() # this updates the topic, see ‘glass.signals’
     # if this is the single message in topic, delete topic:
     if not Message.objects.filter(topic=topic).exists():
         topic.delete()
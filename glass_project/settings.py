@@ -59,11 +59,15 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'glass.assets.AssetMiddleware',
+    'glass.metrics.MetricsMiddleware',
+    'glass.routers.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'glass.admission.AdmissionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -97,9 +101,105 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    },
+    # Read replicas are listed in GLASS_REPLICAS. Copies of SQLite file can
+    # stand in for them locally (see ‘sync_replicas’ command), e.g.:
+    #
+    # 'replica1': {
+    #     'ENGINE': 'django.db.backends.sqlite3',
+    #     'NAME': os.path.join(BASE_DIR, 'replica1.sqlite3'),
+    #     'TEST': {'MIRROR': 'default'},
+    # },
+}
+
+DATABASE_ROUTERS = ['glass.routers.ReplicaRouter']
+
+# Aliases of read replicas, see glass/routers.py.
+GLASS_REPLICAS = ()
+
+# How long users who wrote something keep reading from the primary.
+GLASS_REPLICA_STICKY_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.8/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
 
+GLASS_FRAGMENT_CACHE = 'default' # Cache of rendered messages.
+
+# Seconds to collect toggles of the same like before writing their net
+# effect, 0 writes every toggle immediately (see glass/likes.py).
+GLASS_LIKE_COALESCE_WINDOW = 0
+
+# Sets of messages liked by users with at least this many likes are kept
+# in cache (see glass/likes.py): alias of cache shared by all processes or
+# None to disable it.
+GLASS_LIKES_CACHE = None
+GLASS_LIKED_CACHE_MIN = 1000
+
+# How long shared caches may keep pages for anonymous users before
+# revalidating them (see glass/conditional.py).
+GLASS_PAGE_MAX_AGE = 0
+
+# Cache of whole pages for anonymous users (see glass/pagecache.py): alias
+# of cache shared by all processes or None to disable it, how long pages
+# are fresh and how much longer stale copies may be served while one
+# request renders the page again, in seconds.
+GLASS_PAGE_CACHE = None
+GLASS_PAGE_CACHE_TIMEOUT = 60
+GLASS_PAGE_CACHE_STALE = 300
+
+# Admission control of writes (see glass/admission.py): cache that keeps
+# its state (local memory cache limits every process separately, Memcached
+# shared by all processes limits them together, None disables it), rate of
+# writes per user (per second) and their burst, how many writes may run at
+# once, and average duration of writes of a view (seconds) above which
+# the view sheds new writes.
+GLASS_ADMISSION_CACHE = 'default'
+GLASS_WRITE_RATE = 1
+GLASS_WRITE_BURST = 30
+GLASS_MAX_WRITES_IN_FLIGHT = 8
+GLASS_WRITE_LATENCY_TARGET = 1
+
+# Whether requests for new messages in a topic wait for them (long
+# polling), the longest wait, and how often every process looks for
+# messages posted by other processes while somebody waits (see
+# glass/notify.py). Every waiting client holds a thread and connection to
+# the primary, so long polling needs threaded server sized for that.
+# Without it clients ask again every GLASS_POLL_INTERVAL seconds.
+GLASS_LONG_POLL = False
+GLASS_LONG_POLL_TIMEOUT = 30
+GLASS_NOTIFY_INTERVAL = 1
+GLASS_POLL_INTERVAL = 10
+
+# How many messages are rendered at once when all messages of topic are
+# streamed.
+GLASS_STREAM_BATCH_SIZE = 200
+
+# Age of topic in seconds that is worth ten times more likes in “hot”
+# ordering of topics (see glass/models.py).
+GLASS_HOT_GRAVITY = 45000
+
+# Directory of gzipped snapshots of archived topics, served to anonymous
+# users without data base queries, and how many days a topic must stay
+# without new messages to be archived (see glass/archive.py). None disables
+# archiving.
+GLASS_ARCHIVE_ROOT = None
+GLASS_ARCHIVE_AFTER_DAYS = 365
+
+
+# Metrics (see glass/metrics.py)
+
+GLASS_METRICS_DIR = None # Set to a directory when running several processes.
+GLASS_METRICS_FLUSH_INTERVAL = 1 # How often processes dump metrics, seconds.
+GLASS_METRICS_ALLOWED_IPS = [] # Who can see the metrics, e.g. ['127.0.0.1'].
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -124,6 +224,13 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# Built static files: fingerprinted and precompressed by collectstatic,
+# served by glass.assets.AssetMiddleware when DEBUG is off. Files with
+# hashed names are cached by clients for GLASS_ASSET_MAX_AGE seconds.
+STATIC_ROOT = os.path.join(BASE_DIR, 'assets')
+STATICFILES_STORAGE = 'glass.assets.AssetStorage'
+GLASS_ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
 # Registration
 
 REGISTRATION_OPEN = True       # If True, users can register.
@@ -18,6 +18,8 @@
 # with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import functools
+import multiprocessing
 import os
 import random
 import re
@@ -27,8 +29,16 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'glass_project.settings')
 import django
 django.setup()
 
-from django.contrib.auth.models import User
-from glass.models               import Tag, Topic, Message
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models  import User
+from django.core.management      import call_command
+from django.core.management.color import no_style
+from django.db                   import connection, connections, transaction
+from django.db.models            import F, Max
+from django.template.defaultfilters import slugify
+from glass.markup                import render_markdown
+from glass.models                import Tag, Topic, Message, TagRating
+from glass.models                import update_stats
 
 version = '0.1.0'
 description = 'Populate data base of the Glass project'
@@ -61,11 +71,72 @@ parser.add_argument('-t', '--topics', metavar='N', dest='topics', default=0,
                     type=int, help="how many topics to create")
 parser.add_argument('-m', '--messages', metavar='N', dest='messages', default=0,
                     type=int, help="how many messages to create")
+parser.add_argument('--bulk', action='store_true', dest='bulk',
+                    help="insert objects in batches (much faster, but "
+                    "derived data is recalculated at the end)")
+parser.add_argument('--batch-size', metavar='N', dest='batch_size',
+                    default=10000, type=int,
+                    help="how many objects to insert per transaction "
+                    "in bulk mode")
+parser.add_argument('--max-likes', metavar='N', dest='max_likes', default=10,
+                    type=int, help="maximal number of likes per message "
+                    "in bulk mode")
+parser.add_argument('--fast-hash', action='store_true', dest='fast_hash',
+                    help="hash password once and share the hash between "
+                    "all users created in bulk mode")
+parser.add_argument('--seed', metavar='N', dest='seed', default=None,
+                    type=int, help="seed of random generator, makes "
+                    "results reproducible")
+parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', default=1,
+                    type=int, help="number of processes to create messages "
+                    "with in bulk mode")
 parser.add_argument('--license', action='store_true', dest='show_license',
                     help="show program's license and exit")
 parser.add_argument('--version', action='version',
                     version='%(prog)s ' + version)
 
+USER_NAMES = ['nina','rick','dick','brown','mary','anna','antonio','boba',
+              'michael','rosa','alex','bruno','alfred','nikolay','ivan',
+              'mark','elvis','joseph','ricardo','eleniovey']
+
+TAGS = ['news','music','politics','nonsense','hacking','math','fun',
+        'racking','health','in-pictures','hot']
+
+TOPIC_TITLES = ["Life on Mars?",
+                "Disaster in South Africa",
+                "Evil flute player kills a cat",
+                "Evangelism as way of life",
+                "Radiation can give you new feelings",
+                "Learn a Haskell and make a basket",
+                "Unbelievable power of rats",
+                "Infection in South Africa",
+                "Love cannot bear",
+                "Hunky Dory",
+                "For how long will it be like this?",
+                "More refuges have been destroyed in South Africa",
+                "Red Sails (the contest is open!)",
+                "Previously unknown insects kill people in South Africa",
+                "People in Russia don't speak Russian anymore",
+                "You better think before ridiculing your boss",
+                "Ultrasonic vibrations can increase",
+                "It has grown much bigger than I hoped!",
+]
+
+MESSAGE = ["Cannot imagine this topic is interesting.",
+           "I don't wanna die, so let's address this while we can!",
+           "Well, I don't know a lot about this, it's dirty.",
+           "We should not support this sort of behavior here.",
+           "I don't think so.",
+           "Disagree. This is *quite* interesting.",
+           "Is that a joke?",
+           "This makes me choke.",
+           "Oh, that's one big mess.",
+           "Thoughtful analysis shows **it can be much worse**!",
+           "I've never been to South Africa, but it seems it's hard to live there.",
+           "Press <kbd>Ctrl+F4</kbd> and you're done!",
+           "I can't help it, I need to post a message here!",
+]
+
 class Generator():
     """
     Little auxiliary class implementing logic for generation of objects.
@@ -121,9 +192,6 @@ def populate_users(count):
     always “Smith”, and email is always “foo@example.org”. Password for
     every generated account is “user”.
     """
-    USER_NAMES = ['nina','rick','dick','brown','mary','anna','antonio','boba',
-                  'michael','rosa','alex','bruno','alfred','nikolay','ivan',
-                  'mark','elvis','joseph','ricardo','eleniovey']
 
     def gen_user(username):
         user = User.objects.create_user(username, 'foo@example.org', 'user')
@@ -140,8 +208,6 @@ def populate_tags(count):
     Create ‘count’ new tags in database. Names of tags are unique, they are
     combination of human-readable string and a number.
     """
-    TAGS = ['news','music','politics','nonsense','hacking','math','fun',
-            'racking','health','in-pictures','hot']
 
     def gen_tag(name):
         tag = Tag(name=name)
@@ -157,25 +223,6 @@ def populate_topics(count):
     are combination of human-readable string and a number. Every topic has
     associated collection of tags.
     """
-    TOPIC_TITLES = ["Life on Mars?",
-                    "Disaster in South Africa",
-                    "Evil flute player kills a cat",
-                    "Evangelism as way of life",
-                    "Radiation can give you new feelings",
-                    "Learn a Haskell and make a basket",
-                    "Unbelievable power of rats",
-                    "Infection in South Africa",
-                    "Love cannot bear",
-                    "Hunky Dory",
-                    "For how long will it be like this?",
-                    "More refuges have been destroyed in South Africa",
-                    "Red Sails (the contest is open!)",
-                    "Previously unknown insects kill people in South Africa",
-                    "People in Russia don't speak Russian anymore",
-                    "You better think before ridiculing your boss",
-                    "Ultrasonic vibrations can increase",
-                    "It has grown much bigger than I hoped!",
-    ]
 
     def gen_topic(title):
         topic = Topic(title=title)
@@ -194,20 +241,6 @@ def populate_messages(count):
     pretty stupid right now. There may be a few “likers” from existing
     users (up to 10).
     """
-    MESSAGE = ["Cannot imagine this topic is interesting.",
-               "I don't wanna die, so let's address this while we can!",
-               "Well, I don't know a lot about this, it's dirty.",
-               "We should not support this sort of behavior here.",
-               "I don't think so.",
-               "Disagree. This is *quite* interesting.",
-               "Is that a joke?",
-               "This makes me choke.",
-               "Oh, that's one big mess.",
-               "Thoughtful analysis shows **it can be much worse**!",
-               "I've never been to South Africa, but it seems it's hard to live there.",
-               "Press <kbd>Ctrl+F4</kbd> and you're done!",
-               "I can't help it, I need to post a message here!",
-]
 
     def gen_message(pk):
         message = Message(id=pk)
@@ -216,12 +249,173 @@ def populate_messages(count):
         message.content = random.choice(MESSAGE)
         message.save() # for many-to-many relations
         message.likers = random_objects(User, 0, 10)
+        message.like_count = message.likers.count()
+        Topic.objects.filter(first_message=message)\
+                     .update(rating=message.like_count)
+        TagRating.objects.filter(topic__first_message=message)\
+                         .update(rating=message.like_count)
+        update_stats(message.author_id,
+                     likes=F('likes') + message.like_count)
         return message
 
     gen = Generator(model=Message, p_field='id', object_gen=gen_message,
                     p_field_gen=(lambda: 0))
     gen.generate(count)
 
+def next_id(model):
+    """
+    Return id that follows greatest id of existing objects of ‘model’. Bulk
+    mode assigns ids itself, so it doesn't need to read them back.
+    """
+    return (model.objects.aggregate(m=Max('id'))['m'] or 0) + 1
+
+def in_batches(total, batch_size):
+    """
+    Generate sizes of batches that ‘total’ objects are split into.
+    """
+    while total > 0:
+        yield min(total, batch_size)
+        total -= batch_size
+
+def bulk_users(count, batch_size=10000, fast_hash=False):
+    """
+    Bulk version of ‘populate_users’. If ‘fast_hash’ is true, password is
+    hashed only once.
+    """
+    shared_hash = make_password('user') if fast_hash else None
+    i = next_id(User)
+    for size in in_batches(count, batch_size):
+        users = []
+        for j in range(i, i + size):
+            name = random.choice(USER_NAMES)
+            users.append(User(id=j,
+                              username=name + str(j),
+                              first_name=name.capitalize(),
+                              last_name='Smith',
+                              email='foo@example.org',
+                              password=shared_hash or make_password('user')))
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        i += size
+
+def bulk_tags(count, batch_size=10000):
+    """
+    Bulk version of ‘populate_tags’.
+    """
+    existing = set(Tag.objects.values_list('name', flat=True))
+    i = len(existing)
+    for size in in_batches(count, batch_size):
+        tags = []
+        while len(tags) < size:
+            name = random.choice(TAGS) + str(i)
+            if name not in existing:
+                existing.add(name)
+                tags.append(Tag(name=name))
+            i += 1
+        with transaction.atomic():
+            Tag.objects.bulk_create(tags)
+
+def bulk_topics(count, batch_size=10000):
+    """
+    Bulk version of ‘populate_topics’. Topics are inserted together with
+    their tags.
+    """
+    tags = sorted(Tag.objects.values_list('name', flat=True))
+    through = Topic.tags.through
+    i = next_id(Topic)
+    for size in in_batches(count, batch_size):
+        topics = []
+        topic_tags = []
+        for j in range(i, i + size):
+            title = random.choice(TOPIC_TITLES) + ' ' + str(j)
+            topics.append(Topic(id=j, title=title, slug=slugify(title)))
+            for tag in random.sample(tags, random.randint(min(1, len(tags)),
+                                                          min(3, len(tags)))):
+                topic_tags.append(through(topic_id=j, tag_id=tag))
+        with transaction.atomic():
+            Topic.objects.bulk_create(topics)
+            through.objects.bulk_create(topic_tags)
+        i += size
+
+def bulk_messages_part(first_id, count, batch_size, max_likes, seed):
+    """
+    Create ‘count’ messages with ids starting from ‘first_id’. This is unit
+    of work of single process.
+    """
+    if seed is not None:
+        random.seed(seed)
+    user_ids  = list(User.objects.order_by('id').values_list('id', flat=True))
+    topic_ids = list(Topic.objects.order_by('id').values_list('id', flat=True))
+    rendered  = {content: render_markdown(content) for content in MESSAGE}
+    through   = Message.likers.through
+    max_likes = min(max_likes, len(user_ids))
+    i = first_id
+    for size in in_batches(count, batch_size):
+        messages = []
+        likes = []
+        for j in range(i, i + size):
+            content = random.choice(MESSAGE)
+            likers = random.sample(user_ids, random.randint(0, max_likes))
+            messages.append(Message(id=j,
+                                    author_id=random.choice(user_ids),
+                                    topic_id=random.choice(topic_ids),
+                                    content=content,
+                                    content_html=rendered[content],
+                                    like_count=len(likers),
+                                    version=1))
+            likes.extend(through(message_id=j, user_id=u) for u in likers)
+        with transaction.atomic():
+            Message.objects.bulk_create(messages)
+            through.objects.bulk_create(likes)
+        i += size
+
+def bulk_messages_process(*args):
+    connections.close_all() # don't share connection of parent process
+    bulk_messages_part(*args)
+    connections.close_all()
+
+def bulk_messages(count, batch_size=10000, max_likes=10, jobs=1, seed=None):
+    """
+    Bulk version of ‘populate_messages’. Messages can be created by ‘jobs’
+    processes in parallel, every process gets its own range of ids. Note
+    that on SQLite processes have to take turns writing.
+    """
+    first_id = next_id(Message)
+    if jobs <= 1:
+        return bulk_messages_part(first_id, count, batch_size, max_likes, seed)
+    connections.close_all()
+    part = -(-count // jobs)
+    processes = []
+    for k in range(jobs):
+        part_seed = None if seed is None else seed + k
+        p = multiprocessing.Process(
+            target=bulk_messages_process,
+            args=(first_id + k * part,
+                  max(0, min(part, count - k * part)),
+                  batch_size,
+                  max_likes,
+                  part_seed))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError("worker process failed")
+
+def bulk_finish(**options):
+    """
+    Recalculate data that bulk mode doesn't maintain and make sure that
+    sequences of ids continue after ids assigned in bulk mode. ‘options’
+    are passed to management commands that do the job.
+    """
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                     [User, Topic, Message]):
+            cursor.execute(sql)
+    call_command('rank_topics', **options)
+    call_command('build_search_index', **options)
+    call_command('rebuild_user_stats', **options)
+
 def with_comments(fnc, count, what):
     """
     Execute ‘fnc’ telling the user that ‘count’ objects named ‘what’ are
@@ -240,7 +434,27 @@ if __name__ == '__main__':
         print(license)
         exit(0)
     print("Starting Glass populartion script…")
-    with_comments(populate_users,    args.users,    'users')
-    with_comments(populate_tags,     args.tags,     'tags')
-    with_comments(populate_topics,   args.topics,   'topics')
-    with_comments(populate_messages, args.messages, 'messages')
+    random.seed(args.seed)
+    if args.bulk:
+        batch = args.batch_size
+        with_comments(functools.partial(bulk_users,
+                                        batch_size=batch,
+                                        fast_hash=args.fast_hash),
+                      args.users, 'users')
+        with_comments(functools.partial(bulk_tags, batch_size=batch),
+                      args.tags, 'tags')
+        with_comments(functools.partial(bulk_topics, batch_size=batch),
+                      args.topics, 'topics')
+        with_comments(functools.partial(bulk_messages,
+                                        batch_size=batch,
+                                        max_likes=args.max_likes,
+                                        jobs=args.jobs,
+                                        seed=args.seed),
+                      args.messages, 'messages')
+        print("Updating derived data…")
+        bulk_finish()
+    else:
+        with_comments(populate_users,    args.users,    'users')
+        with_comments(populate_tags,     args.tags,     'tags')
+        with_comments(populate_topics,   args.topics,   'topics')
+        with_comments(populate_messages, args.messages, 'messages')
@@ -1,14 +1,23 @@
-$('span[class^="like-button"]').click(function(){
+function csrfToken() {
+    var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]*)/);
+    return match ? decodeURIComponent(match[1]) : '';
+}
+
+// handlers are delegated, so they work for appended messages too:
+
+$(document).on('click', 'span[class^="like-button"]', function(){
     var obj = $(this);
     var msg_id = obj.attr('data-message-id');
     var action = obj.attr('data-action');
-    $.get(action, {msg_id: msg_id}, function(data) {
-        obj.html(data);
-        obj.toggleClass('label-success label-default');
-    });
+    var params = {msg_id: msg_id, csrfmiddlewaretoken: csrfToken()};
+    $.post(action, params, function(data) {
+        obj.html(data.likes);
+        obj.toggleClass('label-success', data.liked);
+        obj.toggleClass('label-default', !data.liked);
+    }, 'json');
 });
 
-$('a[class^="delete-button"]').click(function(){
+$(document).on('click', 'a[class^="delete-button"]', function(){
     var obj = $(this);
     var msg_id = obj.attr('data-message-id');
     var action = obj.attr('data-action');
@@ -19,3 +28,24 @@ $('a[class^="delete-button"]').click(function(){
         };
     });
 });
+
+// Append new messages of the topic as they are posted (long polling if
+// the server waits for them, otherwise the server tells when to ask again).
+
+function pollMessages(thread) {
+    var params = {since: thread.attr('data-since'), wait: 25};
+    $.getJSON(thread.attr('data-action'), params)
+        .done(function(data) {
+            thread.append(data.html);
+            thread.attr('data-since', data.last_id);
+            setTimeout(function() { pollMessages(thread); },
+                       (data.retry || 0) * 1000);
+        })
+        .fail(function() {
+            setTimeout(function() { pollMessages(thread); }, 5000);
+        });
+}
+
+$('#messages[data-action]').each(function() {
+    pollMessages($(this));
+});